@@ -1,28 +1,34 @@
 import fnmatch
+import functools
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 import os
 import yaml
-import shutil
-from pysteamcmdwrapper import SteamCMD, SteamCMDException, SteamCMD_command
-from steam.webapi import WebAPI
-from pathvalidate import sanitize_filename, sanitize_filepath
+from pathvalidate import sanitize_filename
 
 ARMA_APPID = 107410
 
 
 # noinspection PyGlobalUndefined
-@click.command()
-@click.option('--validate/--no-validate', default=True, help='Validate apps and workshop items')
-@click.option('-u', '--username', prompt='Steam username', default='anonymous', show_default=True,
-              help='Username used for Steam')
-@click.option('-p', '--password', prompt='Steam password', default='', show_default=True,
-              hide_input=True, help='Password used for Steam')
+@click.group(invoke_without_command=True)
+@click.option('--validate/--no-validate', default=None,
+              help='Validate apps and every workshop item, by default only workshop items that fail '
+                   'the local integrity check are validated')
+@click.option('-u', '--username', help='Username used for Steam, asked for when logging in to SteamCMD')
+@click.option('-p', '--password', help='Password used for Steam, asked for when logging in to SteamCMD')
 @click.option('-c', '--config', type=click.Path(readable=True, resolve_path=True),
               default='a3update.yaml', help='Path to a3update.yaml')
 @click.option('-n', '--no-update', is_flag=True, default=False, help='Skips updating mods and Arma')
 @click.option('-s', '---setup', is_flag=True, default=False, help='Runs initial setup')
-def cli(validate, username, password, config, no_update, _setup):
+@click.option('--offline', is_flag=True, default=False,
+              help='Only use cached Steam Web API responses, implies --no-update')
+@click.option('--plan', is_flag=True, default=False,
+              help='Print planned downloads, link changes and repo rebuilds without changing anything')
+@click.pass_context
+def cli(ctx, validate, username, password, config, no_update, _setup, offline, plan):
     # Check yaml existence
     if _setup:
         setup(config)
@@ -37,134 +43,562 @@ def cli(validate, username, password, config, no_update, _setup):
         global CONFIG_YAML
         CONFIG_YAML = yaml.safe_load(file)
 
+    from a3update import metrics
+    metrics.reset()
+    run_start = time.perf_counter()
+
     # Login to SteamCMD and WebAPI
-    _log("Checking SteamCMD install")
-    global STEAM_CMD
-    STEAM_CMD = SteamCMD(CONFIG_YAML['steamcmd_dir'])
-    try:
-        STEAM_CMD.install()
-    except SteamCMDException:
-        click.echo("SteamCMD installed")
-    STEAM_CMD.login(username, password)
+    if offline or plan or ctx.invoked_subcommand in ('rollback', 'export-delta', 'apply-delta'):
+        no_update = True
+    else:
+        from pysteamcmdwrapper import SteamCMD, SteamCMDException
+        _log("Checking SteamCMD install")
+        global STEAM_CMD
+        with metrics.phase('steamcmd_setup'):
+            STEAM_CMD = SteamCMD(CONFIG_YAML['steamcmd_dir'])
+            try:
+                STEAM_CMD.install()
+            except SteamCMDException:
+                click.echo("SteamCMD installed")
+            # Only runs that log in ask for credentials, so the others can run unattended
+            if username is None:
+                username = click.prompt('Steam username', default='anonymous', show_default=True)
+            if password is None:
+                password = click.prompt('Steam password', default='', show_default=False, hide_input=True)
+            STEAM_CMD.login(username, password)
+
+    from a3update.steam_api import SteamWebAPI, DEFAULT_BASE_URL
+    from a3update.webapi_cache import WebAPICache
+    api_config = CONFIG_YAML.get('steam_api', {})
+    cache_config = CONFIG_YAML.get('webapi_cache', {})
     global STEAM_WEBAPI
-    STEAM_WEBAPI = WebAPI(key=CONFIG_YAML['api_key'], https=False)
-
-    # Load constants
+    STEAM_WEBAPI = WebAPICache(
+        None if offline else SteamWebAPI(key=CONFIG_YAML['api_key'],
+                                         base_url=api_config.get('base_url') or DEFAULT_BASE_URL,
+                                         chunk_size=api_config.get('chunk_size', 100),
+                                         concurrency=api_config.get('concurrency', 8)),
+        cache_config.get('directory') or os.path.join(CONFIG_YAML['mod_dir'], 'webapi-cache'),
+        ttl=cache_config.get('ttl', 3600),
+        max_age=cache_config.get('max_age', 604800),
+        offline=offline,
+        read_only=plan,
+    )
+    if not plan:
+        STEAM_WEBAPI.evict()
+
+    # Load constants, everything that differs between profiles is read from the profile
     global WORKSHOP_DIR
     WORKSHOP_DIR = CONFIG_YAML['mod_dir_full']
-    global INSTALL_DIR
-    INSTALL_DIR = CONFIG_YAML['install_dir']
-    global KEY_PATH
-    KEY_PATH = os.path.join(INSTALL_DIR, 'keys')
-    global EXTERNAL_ADDON_DIR
-    EXTERNAL_ADDON_DIR = CONFIG_YAML['external_addon_dir']
+
+    if plan:
+        _print_plan(_resolve_mods(_profiles()))
+        return
+
+    if ctx.invoked_subcommand is not None:
+        ctx.obj = {'validate': validate, 'no_update': no_update}
+        return
+
+    _update(_resolve_mods(_profiles()), validate, no_update, run_start=run_start)
+
+
+@cli.command()
+@click.option('--interval', type=int, help='Seconds between polls of the collections')
+@click.option('--settle', type=int, help='Seconds to wait for further changes before updating')
+@click.pass_context
+def watch(ctx, interval, settle):
+    # Keeps running, polling the collections and updating only the workshop items that changed
+    from a3update import metrics, watch as watcher
+    from a3update.steam_api import RateLimitError
+    watch_config = CONFIG_YAML.get('watch', {})
+    # Every poll asks Steam, cached responses are only used when that fails
+    STEAM_WEBAPI.ttl = 0
+    profiles = _profiles()
+    resolved = {}
+
+    def poll():
+        metrics.reset()
+        STEAM_WEBAPI.hits = STEAM_WEBAPI.misses = 0
+        STEAM_WEBAPI.last_error = None
+        resolved['profile_mods'] = _resolve_mods(profiles)
+        if isinstance(STEAM_WEBAPI.last_error, RateLimitError):
+            raise STEAM_WEBAPI.last_error
+        return _union(resolved['profile_mods'])
+
+    def apply(mods, changed):
+        _update(resolved['profile_mods'], ctx.obj['validate'], ctx.obj['no_update'], changed)
+
+    _log('Watching collections')
+    watcher.run(poll, apply,
+                interval=interval or watch_config.get('interval', 300),
+                settle=settle or watch_config.get('settle', 60),
+                max_backoff=watch_config.get('max_backoff', 3600))
+
+
+@cli.command(help='Make the previous link layout of every staged target live again. Only the links are '
+                  'restored, the mod content is shared by every generation and updated by SteamCMD in place')
+def rollback():
+    # Make the previous generation of every staged target live again
+    from a3update import fingerprint, reconcile, staging
+    for profile in _profiles():
+        _log(_profile_title('Rolling back', profile))
+        for name, target in _link_targets(profile).items():
+            if not target.get('stage') or not staging.rollback(target['stage']):
+                _log('WARN: No previous generation of {} to roll back to'.format(target['path']), e=True)
+                continue
+            stats = reconcile.new_stats()
+            staging.publish_links(target['stage'], target['path'], stats)
+            click.echo('{}: rolled back, {created} created, {removed} removed, {retargeted} retargeted'.format(
+                target['path'], **stats))
+
+        if profile['swifty']['active'] and not profile['swifty'].get('native', False):
+            stage = staging.stage_dir(profile, 'swifty-output')
+            if stage and staging.rollback(stage):
+                click.echo('{}: rolled back'.format(profile['swifty']['output_path']))
+
+        # The publishers no longer match their recorded inputs, neither do the mod.srf
+        # files the native Swifty builder would reuse from the rolled back generation
+        fingerprint.clear(_publish_state_path(profile))
+        if profile['swifty']['active']:
+            from a3update import swifty
+            fingerprint.clear(swifty._state_path(profile))
+
+        if profile['a3sync']['active']:
+            # The ArmA3Sync metadata is not staged and has to be rebuilt
+            from a3update import arma3sync
+            _log(_profile_title('Building ArmA3Sync Repo', profile))
+            arma3sync.update(None, profile)
+    _log('Finished!')
+
+
+@cli.command('export-delta')
+@click.argument('bundle', type=click.Path(dir_okay=False, resolve_path=True))
+@click.option('--since', type=click.Path(exists=True, dir_okay=False, resolve_path=True),
+              help='Manifest or bundle of a previous export, only files that changed since are bundled')
+@click.option('--compress', is_flag=True, default=False, help='Compress the bundle with gzip')
+def export_delta(bundle, since, compress):
+    # Bundles the installed workshop items of every profile for replicas, see apply-delta.
+    # The manifest written next to the bundle is what the next export is made --since
+    from a3update import delta
+    mods = _union(_resolve_mods(_profiles()))
+    file_index = _file_index()
+    _log('Indexing mods')
+    file_index.update([mod['published_file_id'] for mod in mods],
+                      folder_names={mod['published_file_id']: mod['folder_name'] for mod in mods})
+    _log('Exporting delta bundle')
+    delta.export(mods, file_index, bundle, delta.load_manifest(since) if since else None, compress)
+    file_index.close()
+    _log('Finished!')
+
+
+@cli.command('apply-delta')
+@click.argument('bundle', type=click.Path(exists=True, dir_okay=False, resolve_path=True))
+@click.option('--no-link', is_flag=True, default=False, help='Only apply the bundle, without linking the mods')
+def apply_delta(bundle, no_link):
+    # Installs the workshop items of a bundle made by export-delta on another node,
+    # then links them like a run with --no-update would
+    from a3update import delta
+    file_index = _file_index()
+    _log('Applying delta bundle')
+    delta.apply(bundle, file_index, CONFIG_YAML['mod_dir'])
+    file_index.close()
+    if not no_link:
+        _update(_resolve_mods(_profiles()), False, True)
+
+
+def _file_index():
+    from a3update.file_index import FileIndex
+    return FileIndex(CONFIG_YAML.get('file_index') or os.path.join(CONFIG_YAML['mod_dir'], 'file-index.sqlite3'),
+                     WORKSHOP_DIR)
+
+
+# Keys every profile shares with the top level config, they locate and filter the workshop items
+SHARED_KEYS = ('arma_appid', 'steamcmd_dir', 'mod_dir', 'mod_dir_full', 'api_key', 'files_folders_to_ignore',
+               'steamcmd_workers', 'download_tries', 'steam_api', 'webapi_cache', 'file_index', 'integrity', 'gc',
+               'watch', 'metrics')
+
+
+def _profiles():
+    # Every profile is the top level config with its own keys on top, such as collections,
+    # install_dir, handle_keys and the publishers. A config without profiles is a single
+    # profile named None, which keeps its state where it always was
+    profiles = CONFIG_YAML.get('profiles')
+    if not profiles:
+        return [dict(CONFIG_YAML, name=None)]
+
+    result = []
+    outputs = {}
+    for name, overrides in profiles.items():
+        overrides = dict(overrides or {})
+        for key in SHARED_KEYS:
+            if key in overrides:
+                _log('WARN: Profile "{}" cannot override "{}", it is shared by all profiles'.format(name, key), e=True)
+                del overrides[key]
+        profile = dict(CONFIG_YAML, **overrides)
+        del profile['profiles']
+        profile['name'] = name
+
+        # Profiles are linked and published concurrently, so none may write where another does
+        for key, path in _profile_outputs(profile):
+            path = os.path.normpath(path)
+            if outputs.get(path, (name,))[0] != name:
+                raise click.ClickException('Profiles "{}" and "{}" share the output {} ({} and {})'.format(
+                    outputs[path][0], name, path, outputs[path][1], key))
+            outputs[path] = (name, key)
+
+        # State kept in mod_dir is kept apart for each profile, unless the profile sets its own
+        staging_config = dict(profile.get('staging', {}))
+        if not overrides.get('staging', {}).get('directory'):
+            staging_config['directory'] = os.path.join(
+                CONFIG_YAML.get('staging', {}).get('directory') or os.path.join(CONFIG_YAML['mod_dir'], 'staging'),
+                name)
+        profile['staging'] = staging_config
+        if not overrides.get('publish_state'):
+            profile['publish_state'] = os.path.join(CONFIG_YAML['mod_dir'], 'publish-state-{}.json'.format(name))
+        if not overrides.get('swifty', {}).get('state_path'):
+            profile['swifty'] = dict(profile['swifty'], state_path=os.path.join(
+                CONFIG_YAML['mod_dir'], 'swifty-state-{}.json'.format(name)))
+        result.append(profile)
+    return result
+
+
+def _profile_outputs(profile):
+    # (key, path) of everything a profile links or publishes to
+    outputs = [('install_dir', profile['install_dir'])]
+    if profile['a3sync']['active']:
+        outputs.append(('a3sync.directory', profile['a3sync']['directory']))
+    if profile['swifty']['active']:
+        outputs.append(('swifty.output_path', profile['swifty']['output_path']))
+        if not profile['swifty'].get('native', False):
+            from a3update import swifty
+            outputs.append(('swifty basePath', swifty.link_target(profile)['path']))
+    if profile['html_preset']['active']:
+        outputs.append(('html_preset.path_to_html', profile['html_preset']['path_to_html']))
+    return outputs
+
+
+def _profile_title(t, profile):
+    return '{} ({})'.format(t, profile['name']) if profile['name'] else t
+
+
+def _profile_labels(profile):
+    return {'profile': profile['name']} if profile['name'] else {}
+
+
+def _resolve_mods(profiles):
+    # Resolves the collections of every profile at once, so collections and workshop items
+    # they have in common are only requested once. Returns (profile, mods) pairs
+    from a3update import metrics
+    _log('Resolving collections')
+    with metrics.phase('webapi'):
+        children = _get_collection_children([c for profile in profiles for c in profile['collections']])
+        workshop_ids = [_get_collection_workshop_ids(profile['collections'], children=children)
+                        for profile in profiles]
+        mods = {mod['published_file_id']: mod for mod in _workshop_ids_to_mod_array(
+            list(dict.fromkeys(i for ids in workshop_ids for i in ids)))}
+    profile_mods = [(profile, [mods[i] for i in ids if i in mods]) for profile, ids in zip(profiles, workshop_ids)]
+    metrics.set_value('items', len(mods), kind='mods')
+    metrics.set_value('cache_requests', STEAM_WEBAPI.hits, cache='webapi', result='hit')
+    metrics.set_value('cache_requests', STEAM_WEBAPI.misses, cache='webapi', result='miss')
+    return profile_mods
+
+
+def _union(profile_mods):
+    # Every workshop item of any profile, once
+    return list({mod['published_file_id']: mod for _, mods in profile_mods for mod in mods}.values())
+
+
+def _update(profile_mods, validate, no_update, changed=None, run_start=None):
+    # profile_mods pairs every profile with its mods, changed holds the published file ids
+    # that changed since the previous run, None updates the servers and everything else
+    from a3update import manifest, metrics
+    run_start = run_start or time.perf_counter()
+    mods = _union(profile_mods)
 
     # Update apps (Arma 3 Dedicated Server, CDLCs)
-    _log('Updating Arma 3 Server')
-    if not no_update:
-        STEAM_CMD.app_update(CONFIG_YAML['server_appid'], INSTALL_DIR, validate, CONFIG_YAML['beta'])
+    if changed is None:
+        _log('Updating Arma 3 Server')
+        if not no_update:
+            with metrics.phase('server_update'):
+                for profile, _ in profile_mods:
+                    STEAM_CMD.app_update(profile['server_appid'], profile['install_dir'], validate is not False,
+                                         profile['beta'])
+    else:
+        # Unchanged workshop items keep their manifest from the previous run
+        manifest.clear(keep={os.path.join(WORKSHOP_DIR, mod['published_file_id'])
+                             for mod in mods if mod['published_file_id'] not in changed})
+
+    file_index = _file_index()
 
-    # Update mods
+    # Update mods, every profile shares mod_dir so each workshop item is downloaded once
     _log('Updating mods')
-    for filename in os.listdir(INSTALL_DIR):
-        if filename.startswith('@'):
-            shutil.rmtree(os.path.join(INSTALL_DIR, filename))
-
-    if CONFIG_YAML['handle_keys']:
-        # Delete key symlinks
-        for filename in os.listdir(KEY_PATH):
-            f = os.path.join(KEY_PATH, filename)
-            if os.path.islink(f):
-                os.unlink(f)
-
-    mods = _workshop_ids_to_mod_array(_get_collection_workshop_ids(CONFIG_YAML['collections']))
+    failed_ids = set()
     if not no_update:
-        mods_cp = mods.copy()
-        while len(mods_cp) > 0:
-            # Only update 25 mods at a time
-            # avoids command line length limitations
-            # and prevents having to start over from the
-            # absolute beginning when it fails
-            mods_slice = mods_cp[:25]
-            ws_update_command = SteamCMD_command()
-            ws_update_command.force_install_dir(CONFIG_YAML['mod_dir'])
-            for mod in mods_slice:
-                ws_update_command.workshop_download_item(ARMA_APPID, mod['published_file_id'], validate=True)
-            STEAM_CMD.execute(ws_update_command, n_tries=50)
-            mods_cp = mods_cp[25:]
-
-    # Generate file paths
-    for mod in mods:
-        # Create symbolic links to keep files lowercase without renaming
-        path = os.path.join(WORKSHOP_DIR, mod['published_file_id'])
-        _create_mod_link(
-            path,
-            os.path.join(INSTALL_DIR, mod['folder_name'])
-        )
-
-        if CONFIG_YAML['handle_keys']:
-            # Create key symlinks
-            if not _create_key_links(path):
-                _log('WARN: No bikeys found for: {}'.format(mod['name']), e=True)
-
-    # Handle external addons
-    if os.path.isdir(EXTERNAL_ADDON_DIR):
-        for filename in os.listdir(EXTERNAL_ADDON_DIR):
-            out_path = os.path.join(INSTALL_DIR, _filename(filename))
-            if not os.path.exists(out_path):
-                _create_mod_link(os.path.join(EXTERNAL_ADDON_DIR, filename), out_path)
-            else:
-                _log('ERR: Conflicting external addon "{}"'.format(filename), e=True)
+        from a3update import download, integrity, workshop
+        integrity_config = CONFIG_YAML.get('integrity', {})
+        integrity_state = integrity_config.get('state_path') or os.path.join(CONFIG_YAML['mod_dir'],
+                                                                             'integrity-state.json')
+        candidates = mods if changed is None else [mod for mod in mods if mod['published_file_id'] in changed]
+        installed = workshop.installed_items(CONFIG_YAML['mod_dir'], WORKSHOP_DIR)
+        mods_cp = workshop.outdated_mods(candidates, installed)
+        click.echo('{} of {} workshop items need updating'.format(len(mods_cp), len(mods)))
+
+        # SteamCMD validation rereads every file of an item, so by default it is only
+        # used for items whose files drifted from the index or on a periodic full validation
+        full_validation = validate is True or (validate is None and integrity.full_validation_due(
+            integrity_state, integrity_config.get('full_validation_interval', 2592000)))
+        if full_validation:
+            _log('Validating every workshop item')
+            outdated_ids = {mod['published_file_id'] for mod in mods_cp}
+            mods_cp += [mod for mod in candidates if mod['published_file_id'] not in outdated_ids]
+            mods_cp = [dict(mod, validate=True) for mod in mods_cp]
+        elif validate is None:
+            outdated_ids = {mod['published_file_id'] for mod in mods_cp}
+            with metrics.phase('integrity'):
+                drift = integrity.drifted([mod for mod in candidates if mod['published_file_id'] not in outdated_ids
+                                           and mod['published_file_id'] in installed],
+                                          file_index, integrity_config.get('sample_files', 0))
+            click.echo('{} workshop items failed the integrity check'.format(len(drift)))
+            metrics.set_value('items', len(drift), kind='mods_drifted')
+            mods_cp += [dict(mod, validate=True) for mod in drift]
+
+        with metrics.phase('download'):
+            failed = download.download(functools.partial(download.run_steamcmd, STEAM_CMD), mods_cp,
+                                       CONFIG_YAML['mod_dir'],
+                                       workers=CONFIG_YAML.get('steamcmd_workers', 1),
+                                       max_tries=CONFIG_YAML.get('download_tries', 5))
+        failed_ids = {mod['published_file_id'] for mod in failed}
+        if full_validation and not failed_ids:
+            integrity.record_full_validation(integrity_state)
+        metrics.set_value('items', len(mods_cp), kind='mods_outdated')
+        metrics.set_value('items', len(failed_ids), kind='mods_failed')
+        metrics.set_value('items', sum(1 for mod in mods_cp if mod.get('validate')), kind='mods_validated')
+        # SteamCMD does not report what it transferred, so this is the published size of every item it handled
+        for mod in mods_cp:
+            if mod['published_file_id'] not in failed_ids:
+                metrics.set_value('queued_bytes', mod['file_size'], mod=mod['published_file_id'])
+
+        # Items that were scanned by the integrity check and then downloaded are scanned again
+        downloaded_ids = {mod['published_file_id'] for mod in mods_cp}
+        manifest.clear(keep={os.path.join(WORKSHOP_DIR, mod['published_file_id'])
+                             for mod in mods if mod['published_file_id'] not in downloaded_ids})
+
+    # Plan the link trees, this scans every mod once however many profiles use it
+    from a3update import reconcile
+    _log('Planning links')
+    with metrics.phase('plan'):
+        link_plans = [reconcile.plan(modset, profile, file_index) for profile, modset in profile_mods]
+
+    # Index the workshop content, only rehashing files that changed. Items that failed to
+    # download keep their rows, a failed repair would otherwise become the new baseline
+    _log('Indexing mods')
+    with metrics.phase('index'):
+        changed_mods = file_index.update([mod['published_file_id'] for mod in mods], keep=failed_ids)
+    click.echo('Mods with changed files: {}'.format(len(changed_mods)))
+    metrics.set_value('items', len(changed_mods), kind='mods_changed')
+
+    # The profiles only share read access to the workshop items, so they are linked in parallel
+    with ThreadPoolExecutor(max_workers=len(profile_mods)) as executor:
+        list(executor.map(lambda args: _materialize(*args, changed=changed),
+                          [(profile, modset, link_plan)
+                           for (profile, modset), link_plan in zip(profile_mods, link_plans)]))
+
+    # Drop workshop items that are no longer part of any profile's collections
+    if CONFIG_YAML.get('gc', {}).get('active', True) and mods:
+        from a3update import workshop_gc
+        _log('Collecting orphaned workshop items')
+        with metrics.phase('gc'):
+            workshop_gc.collect(mods, CONFIG_YAML)
+
+    file_index.close()
+
+    metrics.set_value('phase_seconds', time.perf_counter() - run_start, phase='total')
+    metrics_config = CONFIG_YAML.get('metrics', {})
+    metrics.write(metrics_config.get('json_path', os.path.join(CONFIG_YAML['mod_dir'], 'a3update-metrics.json')),
+                  metrics_config.get('prometheus_path'))
 
-    if CONFIG_YAML['a3sync']['active']:
-        from a3update import arma3sync
-        _log('Building ArmA3Sync Repo')
-        arma3sync.update(mods, CONFIG_YAML)
-        _log('Finished building ArmA3Sync Repo')
+    _log('Finished!')
 
-    if CONFIG_YAML['html_preset']['active']:
-        from a3update import html_preset
-        _log('Generating Arma Launcher Preset')
-        html_preset.generate(mods, CONFIG_YAML)
-        _log('Finished generating Arma Launcher Preset')
 
-    if CONFIG_YAML['swifty']['active']:
+def _materialize(profile, mods, link_plan, changed=None):
+    # Links, publishes and builds the repos of one profile
+    from a3update import metrics, reconcile
+    labels = _profile_labels(profile)
+
+    # Reconcile the server and the repo link trees with what is on disk,
+    # after a change only the changed mods and the external addons are walked in unstaged targets
+    only = None
+    if changed is not None:
+        only = {folder_name for folder_name, input_path in link_plan['mods'].items()
+                if os.path.dirname(input_path) != WORKSHOP_DIR or os.path.basename(input_path) in changed}
+    _log(_profile_title('Linking mods', profile))
+    targets = _link_targets(profile)
+    with metrics.phase('link', **labels):
+        link_stats = dict(zip(targets, reconcile.apply(link_plan, list(targets.values()), only=only)))
+
+    # The Swifty repo files sit inside the mod folders, so they are built before publishing
+    swifty_native = profile['swifty']['active'] and profile['swifty'].get('native', False)
+    if swifty_native:
         from a3update import swifty
-        _log('Building Swifty Repo')
-        swifty.update(mods, CONFIG_YAML)
-        _log('Finished building Swifty Repo')
-
-    _log('Finished!')
+        _log(_profile_title('Building Swifty Repo', profile))
+        with metrics.phase('swifty', **labels):
+            swifty.update(mods, profile, link_plan, reconcile.build_path(targets['swifty']))
+        _log(_profile_title('Finished building Swifty Repo', profile))
+
+    # Make the staged link trees live
+    _log(_profile_title('Publishing mods', profile))
+    with metrics.phase('publish', **labels):
+        publish_stats = dict(zip(targets, reconcile.publish(list(targets.values()))))
+    stats = reconcile.new_stats()
+    for target, target_stats in link_stats.items():
+        for k in stats:
+            target_stats[k] += publish_stats[target][k]
+            stats[k] += target_stats[k]
+            metrics.set_value('links', target_stats[k], target=target, operation=k, **labels)
+    reconcile.log_stats(stats)
+
+    # Publishers only run when their inputs changed since they last succeeded
+    fingerprints = _fingerprints(profile, mods, link_plan)
+    if profile['a3sync']['active']:
+        from a3update import arma3sync
+        _log(_profile_title('Building ArmA3Sync Repo', profile))
+        with metrics.phase('a3sync', **labels):
+            _publish(profile, 'a3sync', fingerprints, link_stats['a3sync'],
+                     lambda: arma3sync.update(mods, profile, link_plan, link_stats['a3sync']))
+        _log(_profile_title('Finished building ArmA3Sync Repo', profile))
 
+    if profile['html_preset']['active']:
+        from a3update import html_preset
+        _log(_profile_title('Generating Arma Launcher Preset', profile))
+        with metrics.phase('html_preset', **labels):
+            _publish(profile, 'html_preset', fingerprints, None, lambda: html_preset.generate(mods, profile))
+        _log(_profile_title('Finished generating Arma Launcher Preset', profile))
 
-def _create_key_links(path):
-    keys = _find_bikeys(path)
-    linked_keys = []
-    if keys:
-        for key in keys:
-            key_link = _filename(os.path.basename(key))
-            key_path = os.path.join(KEY_PATH, key_link)
-            if not os.path.exists(key_path):
-                os.symlink(
-                    key,
-                    key_path
-                )
-                linked_keys.append(key_link)
+    if profile['swifty']['active'] and not swifty_native:
+        from a3update import swifty
+        _log(_profile_title('Building Swifty Repo', profile))
+        with metrics.phase('swifty', **labels):
+            _publish(profile, 'swifty', fingerprints, link_stats['swifty'],
+                     lambda: swifty.update(mods, profile, link_plan))
+        _log(_profile_title('Finished building Swifty Repo', profile))
+
+
+def _fingerprints(profile, mods, link_plan):
+    # The native Swifty builder keeps its own per mod state and is not fingerprinted
+    from a3update import fingerprint
+    fingerprints = {}
+    if profile['a3sync']['active']:
+        fingerprints['a3sync'] = fingerprint.compute(mods, link_plan, profile['a3sync'])
+    if profile['html_preset']['active']:
+        fingerprints['html_preset'] = fingerprint.compute(mods, link_plan, profile['html_preset'])
+    if profile['swifty']['active'] and not profile['swifty'].get('native', False):
+        with click.open_file(profile['swifty']['path_to_json']) as f:
+            fingerprints['swifty'] = fingerprint.compute(mods, link_plan, profile['swifty'], f.read())
+    return fingerprints
+
+
+def _publish(profile, name, fingerprints, link_stats, build):
+    # build returns False when it failed, so it is retried on the next run
+    from a3update import fingerprint, metrics
+    labels = _profile_labels(profile)
+    if not _publish_due(profile, name, fingerprints, link_stats):
+        click.echo('Inputs unchanged, skipping')
+        metrics.set_value('items', 1, kind='publisher_skipped', publisher=name, **labels)
+        return
+    metrics.set_value('items', 0, kind='publisher_skipped', publisher=name, **labels)
+    if build() is not False:
+        fingerprint.record(_publish_state_path(profile), name, fingerprints[name])
+
+
+def _publish_due(profile, name, fingerprints, link_stats=None):
+    # A publisher is due when its fingerprint differs from its last successful run,
+    # its output is missing or links in its target changed
+    from a3update import fingerprint
+    output_path = {
+        'a3sync': lambda: os.path.join(profile['a3sync']['directory'], '.a3s'),
+        'html_preset': lambda: profile['html_preset']['path_to_html'],
+        'swifty': lambda: os.path.join(profile['swifty']['output_path'], 'repo.json'),
+    }[name]()
+    return not fingerprint.unchanged(_publish_state_path(profile), name, fingerprints[name], output_path) \
+        or any((link_stats or {}).values())
+
+
+def _publish_state_path(profile):
+    return profile.get('publish_state') or os.path.join(profile['mod_dir'], 'publish-state.json')
+
+
+def _print_plan(profile_mods):
+    # Dry run of everything after the server update, nothing on disk is changed
+    from a3update import reconcile, workshop
+    mods = _union(profile_mods)
+    _log('Planned downloads')
+    mods_cp = workshop.outdated_mods(mods, workshop.installed_items(CONFIG_YAML['mod_dir'], WORKSHOP_DIR))
+    click.echo('{} of {} workshop items need updating'.format(len(mods_cp), len(mods)))
+    for mod in mods_cp:
+        click.echo('  {} ({}, {} bytes)'.format(mod['name'], mod['published_file_id'], mod['file_size']))
+
+    link_plans = []
+    for profile, modset in profile_mods:
+        _log(_profile_title('Planned link changes', profile))
+        link_plan = reconcile.plan(modset, profile)
+        link_plans.append(link_plan)
+        targets = _link_targets(profile, keys=False)
+        link_stats = dict(zip(targets, reconcile.apply(link_plan, list(targets.values()), dry_run=True)))
+
+        if profile['handle_keys']:
+            _log(_profile_title('Planned key changes', profile))
+            key_path = os.path.join(profile['install_dir'], 'keys')
+            key_stats = reconcile.new_stats()
+            reconcile.reconcile_keys(link_plan['keys'], key_path, key_stats, dry_run=True)
+            click.echo('{}: {created} created, {removed} removed, {retargeted} retargeted'.format(key_path,
+                                                                                                   **key_stats))
+
+        _log(_profile_title('Planned repo rebuilds', profile))
+        fingerprints = _fingerprints(profile, modset, link_plan)
+        if profile['a3sync']['active']:
+            from a3update import arma3sync
+            if _publish_due(profile, 'a3sync', fingerprints, link_stats['a3sync']):
+                arma3sync.plan(profile, link_plan, link_stats['a3sync'])
             else:
-                linked_keys.append(key_link)
-                _log('WARN: Duplicate key: {}'.format(key_link), e=True)
-
-    return linked_keys
-
+                click.echo('ArmA3Sync repo: unchanged')
+        if profile['html_preset']['active']:
+            if _publish_due(profile, 'html_preset', fingerprints):
+                click.echo('Launcher preset: regenerate {}'.format(profile['html_preset']['path_to_html']))
+            else:
+                click.echo('Launcher preset: unchanged')
+        if profile['swifty']['active']:
+            from a3update import swifty
+            if profile['swifty'].get('native', False) \
+                    or _publish_due(profile, 'swifty', fingerprints, link_stats['swifty']):
+                swifty.plan(profile, link_plan)
+            else:
+                click.echo('Swifty repo: unchanged')
+
+    if CONFIG_YAML.get('gc', {}).get('active', True) and mods:
+        from a3update import workshop_gc
+        _log('Orphaned workshop items')
+        workshop_gc.collect(mods, CONFIG_YAML, dry_run=True)
+
+
+def _link_targets(profile, keys=True):
+    from a3update import staging
+    targets = {'server': {
+        'path': profile['install_dir'],
+        'key_path': os.path.join(profile['install_dir'], 'keys') if keys and profile['handle_keys'] else None,
+        'stage': staging.stage_dir(profile, 'server'),
+    }}
+    if profile['a3sync']['active']:
+        from a3update import arma3sync
+        targets['a3sync'] = arma3sync.link_target(profile)
+    if profile['swifty']['active']:
+        from a3update import swifty
+        targets['swifty'] = swifty.link_target(profile)
+    return targets
 
-def _find_bikeys(path):
-    keys = []
 
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            if file.lower().endswith('.bikey'):
-                keys.append(os.path.join(root, file))
-    return keys
+# Names sanitize_filename would return unchanged, checking for them first skips its slow validation
+_SAFE_FILENAME = re.compile(r'[a-z0-9_@-][a-z0-9_.@-]*')
+_RESERVED_FILENAMES = frozenset(['con', 'prn', 'aux', 'nul'] +
+                                ['{}{}'.format(p, i) for p in ('com', 'lpt') for i in range(10)])
 
 
 def _filename(f):
@@ -172,6 +606,9 @@ def _filename(f):
     f = f.replace(' ', '_')  # Replace spaces with underscores
     f = f.replace('%20', '_')  # Replace url encoded spaces
     f = f.replace('+', '')  # Remove plus signs
+    if len(f) <= 255 and _SAFE_FILENAME.fullmatch(f) and not f.endswith('.') \
+            and f.split('.', 1)[0] not in _RESERVED_FILENAMES:
+        return f
     return sanitize_filename(f, platform='universal')
 
 
@@ -182,46 +619,64 @@ def _log(t, e=False):
     click.echo("{{0:=<{}}}".format(len(t)).format(""), err=e)
 
 
-def _is_ignored_file(f):
-    if CONFIG_YAML['files_folders_to_ignore']:
-        for p in CONFIG_YAML['files_folders_to_ignore']:
-            if fnmatch.fnmatch(f, p):
-                return True
-
-    return False
-
-
-def _create_mod_link(input_path, output_path):
-    if os.path.isdir(output_path):
-        shutil.rmtree(output_path)
-
-    os.mkdir(sanitize_filepath(output_path, platform='auto'))
-
-    for filename in os.listdir(input_path):
-        f = os.path.join(input_path, filename)
-        if _is_ignored_file(filename):
-            click.echo('Ignored file/folder: {}'.format(f))
+def _is_ignored_file(f, path=None):
+    # f is a bare file or folder name, path its position relative to the
+    # output directory (e.g. "@mod/optional/file.pbo"), if known
+    name_rule, path_rule = _ignore_rules(tuple(CONFIG_YAML['files_folders_to_ignore'] or ()))
+    if name_rule is not None and name_rule.match(f):
+        return True
+    return path_rule is not None and path is not None and path_rule.match(path) is not None
+
+
+@functools.lru_cache()
+def _ignore_rules(patterns):
+    # Compile every pattern into a single expression for names and one for paths,
+    # patterns containing a "/" are matched against the path and support "**"
+    name_patterns = []
+    path_patterns = []
+    for p in patterns:
+        if '/' in p:
+            path_patterns.append(_path_glob_to_regex(p.strip('/')))
         else:
-            if os.path.isdir(f):
-                _create_mod_link(
-                    f,
-                    os.path.join(
-                        output_path,
-                        _filename(filename)
-                    )
-                )
-            else:
-                os.symlink(
-                    f,
-                    os.path.join(
-                        output_path,
-                        _filename(filename)
-                    )
-                )
+            name_patterns.append(fnmatch.translate(p))
+
+    return (
+        re.compile('|'.join(name_patterns)) if name_patterns else None,
+        re.compile('|'.join(path_patterns)) if path_patterns else None,
+    )
+
+
+def _path_glob_to_regex(p):
+    regex = ''
+    i = 0
+    while i < len(p):
+        if p.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif p.startswith('/**', i) and i + 3 == len(p):
+            regex += '(?:/.*)?'
+            i += 3
+        elif p.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif p[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif p[i] == '?':
+            regex += '[^/]'
+            i += 1
+        else:
+            regex += re.escape(p[i])
+            i += 1
+    return '(?s:{})\\Z'.format(regex)
 
 
 def _workshop_ids_to_mod_array(workshop_ids):
+    if not workshop_ids:
+        return []
     published_file_details = _get_published_file_details(workshop_ids)
+    if not published_file_details:
+        raise _no_response('workshop items')
 
     mod_arr = []
     for i in range(0, published_file_details['resultcount']):
@@ -231,29 +686,60 @@ def _workshop_ids_to_mod_array(workshop_ids):
             'name': file_details['title'],
             'folder_name': '@{}'.format(_filename(file_details['title'])),
             'published_file_id': file_details['publishedfileid'],
+            'time_updated': int(file_details.get('time_updated', 0)),
+            'file_size': int(file_details.get('file_size', 0)),
         })
 
     return mod_arr
 
 
-def _get_collection_workshop_ids(collection_ids, nested_collections=True):
+def _get_collection_children(collection_ids, nested_collections=True):
+    # Fetch the collection graph level by level, using one batched request
+    # for the children and one for the titles of every collection on a level
+    children = {}
+    level = list(dict.fromkeys(str(c) for c in collection_ids))
+    visited = set(level)
+    while level:
+        collection_details = _get_collection_details(level)
+        if not collection_details:
+            raise _no_response('collections')
+        for file_details in _get_published_file_details(level).get('publishedfiledetails', []):
+            click.echo('Processing collection "{}"'.format(
+                file_details.get('title', file_details['publishedfileid'])
+            ))
+
+        next_level = []
+        for collection in collection_details.get('collectiondetails', []):
+            children[collection['publishedfileid']] = collection.get('children', [])
+            for c in children[collection['publishedfileid']]:
+                if nested_collections and c['filetype'] == 2 and c['publishedfileid'] not in visited:
+                    visited.add(c['publishedfileid'])
+                    next_level.append(c['publishedfileid'])
+        level = next_level
+    return children
+
+
+def _get_collection_workshop_ids(collection_ids, nested_collections=True, children=None):
+    # children may hold the graph of a superset of the collections, fetched beforehand
+    if children is None:
+        children = _get_collection_children(collection_ids, nested_collections)
+
+    # Walk the resolved graph depth first, keeping the order of the collections
     workshop_items = []
-    collection_details = _get_collection_details(collection_ids)
-
-    for i in range(0, collection_details['resultcount']):
-        collection = collection_details['collectiondetails'][i]
-        click.echo('Processing collection "{}"'.format(
-            _get_published_file_details([collection['publishedfileid']])['publishedfiledetails'][0]['title']
-        ))
+    seen_items = set()
+    expanded = set()
 
-        for c in collection['children']:
+    def expand(collection_id):
+        expanded.add(collection_id)
+        for c in children.get(collection_id, []):
             filetype = c['filetype']
             if nested_collections and filetype == 2:
-                # Recursion on nested collections, hopefully we don't run into an infinite loop
-                workshop_items = workshop_items + _get_collection_workshop_ids([c['publishedfileid']])
+                if c['publishedfileid'] not in expanded:
+                    expand(c['publishedfileid'])
             elif filetype == 0:
                 mod = c['publishedfileid']
-                if mod not in workshop_items:
+                if mod not in seen_items:
+                    seen_items.add(mod)
                     workshop_items.append(mod)
             else:
                 _log(
@@ -261,13 +747,18 @@ def _get_collection_workshop_ids(collection_ids, nested_collections=True):
                     e=True
                 )
 
+    for collection_id in dict.fromkeys(str(c) for c in collection_ids):
+        if collection_id not in expanded:
+            expand(collection_id)
+
     return workshop_items
 
 
 # https://steamapi.xpaw.me/#ISteamRemoteStorage/GetCollectionDetails
 def _get_collection_details(collection_ids):
-    response = STEAM_WEBAPI.ISteamRemoteStorage.GetCollectionDetails(collectioncount=len(collection_ids),
-                                                                     publishedfileids=collection_ids)
+    response = STEAM_WEBAPI.call('ISteamRemoteStorage.GetCollectionDetails',
+                                 collectioncount=len(collection_ids),
+                                 publishedfileids=collection_ids)
     if 'response' in response:
         response = response['response']
         if response['resultcount'] != len(collection_ids):
@@ -281,10 +772,19 @@ def _get_collection_details(collection_ids):
         return {}
 
 
+def _no_response(what):
+    # Without a response the modset is unknown, carrying on would unlink and collect every mod
+    if STEAM_WEBAPI.offline:
+        return click.ClickException('No cached Steam Web API response for the {} exists, '
+                                    'run once without --offline'.format(what))
+    return click.ClickException('Steam Web API returned no response for the {}'.format(what))
+
+
 # https://steamapi.xpaw.me/#ISteamRemoteStorage/GetPublishedFileDetails
 def _get_published_file_details(published_file_ids):
-    response = STEAM_WEBAPI.ISteamRemoteStorage.GetPublishedFileDetails(itemcount=len(published_file_ids),
-                                                                        publishedfileids=published_file_ids)
+    response = STEAM_WEBAPI.call('ISteamRemoteStorage.GetPublishedFileDetails',
+                                 itemcount=len(published_file_ids),
+                                 publishedfileids=published_file_ids)
     if 'response' in response:
         response = response['response']
         if response['resultcount'] != len(published_file_ids):
@@ -316,11 +816,61 @@ def setup(config_path):
                                            default='mods/external', show_default=True,
                                            type=click.Path(file_okay=False, resolve_path=True)),
         'beta': click.prompt('Beta branch', default=''),
+        'steamcmd_workers': click.prompt('Number of SteamCMD processes downloading mods in parallel',
+                                         default=1, show_default=True, type=int),
+        'download_tries': 5,
         'collections': list(map(int, (click.prompt("List of Collections, separated by spaces", default='').split()))),
         'handle_keys': click.confirm('Handle bikey files automatically', default=False, show_default=True),
         'api_key': click.prompt('Enter Steam API key (https://steamcommunity.com/dev/apikey)'),
         'files_folders_to_ignore': (click.prompt("List of files and folders to ignore, separated by spaces. "
-                                                 "Wildcards supported.", default='').split()),
+                                                 "Wildcards supported, patterns containing / match paths "
+                                                 "such as @mod/optional/**", default='').split()),
+        'link_modes': click.prompt('Ways to link mod folders in order of preference, separated by spaces '
+                                   '(dir, reflink, hardlink, symlink)', default='dir symlink',
+                                   show_default=True).split(),
+        # Profiles override any key but the shared ones, such as collections, install_dir,
+        # handle_keys, a3sync, swifty and html_preset, see SHARED_KEYS
+        'profiles': {},
+        'steam_api': {
+            'base_url': 'https://api.steampowered.com',
+            'chunk_size': 100,
+            'concurrency': 8,
+        },
+        'gc': {
+            'active': True,
+            'grace_period': click.prompt('Days to keep workshop items that were removed from all collections',
+                                         default=7, show_default=True, type=int) * 86400,
+            'state_path': None,
+        },
+        'staging': {
+            'active': click.confirm('Build mod folders in a staging directory and publish them atomically',
+                                    default=True, show_default=True),
+            'directory': None,
+        },
+        'watch': {
+            'interval': 300,
+            'settle': 60,
+            'max_backoff': 3600,
+        },
+        'integrity': {
+            'sample_files': click.prompt('Files per workshop item to rehash when checking their integrity',
+                                         default=0, show_default=True, type=int),
+            'full_validation_interval': click.prompt('Days between full SteamCMD validations of every workshop '
+                                                     'item, 0 to disable', default=30, show_default=True,
+                                                     type=int) * 86400,
+            'state_path': None,
+        },
+        'webapi_cache': {
+            'directory': None,
+            'ttl': click.prompt('Seconds to reuse cached Steam Web API responses',
+                                default=3600, show_default=True, type=int),
+            'max_age': 604800,
+        },
+        'metrics': {
+            'json_path': None,
+            'prometheus_path': click.prompt('Path of a Prometheus textfile collector file to write run metrics to, '
+                                            'leave empty to disable', default='') or None,
+        },
     }
 
     # Create directories
@@ -335,6 +885,9 @@ def setup(config_path):
 
     configuration['mod_dir_full'] = os.path.join(configuration['mod_dir'], 'steamapps',
                                                  'workshop', 'content', str(ARMA_APPID))
+    configuration['webapi_cache']['directory'] = os.path.join(configuration['mod_dir'], 'webapi-cache')
+    configuration['staging']['directory'] = os.path.join(configuration['mod_dir'], 'staging')
+    configuration['metrics']['json_path'] = os.path.join(configuration['mod_dir'], 'a3update-metrics.json')
 
     # ArmA3Sync Configuration
     from a3update import arma3sync
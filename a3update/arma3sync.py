@@ -1,8 +1,10 @@
+import hashlib
 import os
 import click
 import subprocess
 import shutil
-from a3update.a3update import _create_mod_link, _filename, _log
+from a3update import metrics, staging, zsync
+from a3update.manifest import get_manifest
 
 
 def _setup(config):
@@ -22,6 +24,8 @@ def _setup(config):
             'path_to_jar': path_to_jar,
             'repo_name': repo_name,
             'directory': shared_directory,
+            'native_zsync': click.confirm('Generate .zsync files natively instead of through ArmA3Sync',
+                                          default=True, show_default=True),
         }
     else:
         config['a3sync'] = {
@@ -29,76 +33,185 @@ def _setup(config):
             'path_to_jar': None,
             'repo_name': None,
             'directory': None,
+            'native_zsync': False,
         }
 
 
-def update(mods, config_yaml):
-    output_dir = config_yaml['a3sync']['directory']
+def link_target(config_yaml):
+    # .zsync files sit next to the files they describe and are kept across runs,
+    # the ones that would be lost to a renamed or moved mod are relocated by content.
+    # Both rely on the link targets of the files, so every file is symlinked
+    return {
+        'path': config_yaml['a3sync']['directory'],
+        'link_modes': ('symlink',),
+        'preserve': ('*.zsync',),
+        'prepare': _stash_zsync,
+        'finish': _restore_zsync,
+        'stage': staging.stage_dir(config_yaml, 'a3sync'),
+    }
+
 
-    # Store .zsync files in a temporary directory
-    print('Caching .zsync files')
+def _stash_zsync(output_dir, link_plan):
     zsync_storage = os.path.join(output_dir, 'zsync-temp')
     if os.path.exists(zsync_storage):
         shutil.rmtree(zsync_storage)
     os.mkdir(zsync_storage)
-    cache_count = 0
-    for root, dirs, files in os.walk(output_dir):
-        temp_dir = os.path.join(zsync_storage, os.path.relpath(root, output_dir))
 
-        if 'zsync-temp' in root:
+    stash_count = 0
+    prune_count = 0
+    for folder_name in os.listdir(output_dir):
+        if not folder_name.startswith('@'):
             continue
 
-        if not os.path.exists(temp_dir):
-            os.mkdir(temp_dir)
+        input_path = link_plan['mods'].get(folder_name)
+        desired = {}
+        if input_path is not None:
+            desired = {entry.link_path: entry for entry in get_manifest(input_path) if not entry.is_dir}
+
+        for root, dirs, files in os.walk(os.path.join(output_dir, folder_name)):
+            for f in files:
+                if not f.endswith('.zsync'):
+                    continue
+
+                zsync_path = os.path.join(root, f)
+                path = zsync_path[:-len('.zsync')]
+                entry = desired.get(os.path.relpath(path, os.path.join(output_dir, folder_name)))
+                if entry is not None and os.path.islink(path) \
+                        and os.readlink(path) == os.path.join(input_path, entry.path):
+                    # Stays where it is
+                    continue
+
+                if os.path.exists(path):
+                    stash_path = os.path.join(zsync_storage, _identity(path, link_plan['index']) + '.zsync')
+                    if not os.path.exists(stash_path):
+                        os.rename(zsync_path, stash_path)
+                        stash_count += 1
+                        continue
+                os.remove(zsync_path)
+                prune_count += 1
+
+    click.echo('Relocating {} .zsync files, pruned {} stale .zsync files'.format(stash_count, prune_count))
+    metrics.set_value('items', stash_count, kind='zsync_stashed')
+
+
+def _restore_zsync(output_dir, link_plan):
+    zsync_storage = os.path.join(output_dir, 'zsync-temp')
+    stash = set(os.listdir(zsync_storage))
+
+    reuse_count = 0
+    if stash:
+        for folder_name, input_path in link_plan['mods'].items():
+            for entry in get_manifest(input_path):
+                if entry.is_dir:
+                    continue
+
+                zsync_path = os.path.join(output_dir, folder_name, entry.link_path) + '.zsync'
+                if os.path.exists(zsync_path):
+                    continue
+
+                stash_name = _identity(os.path.join(input_path, entry.path), link_plan['index']) + '.zsync'
+                if stash_name in stash:
+                    os.rename(os.path.join(zsync_storage, stash_name), zsync_path)
+                    stash.remove(stash_name)
+                    reuse_count += 1
+
+    # Whatever was not claimed belongs to files that no longer exist
+    shutil.rmtree(zsync_storage)
+    click.echo('Reused {} relocated .zsync files, pruned {} stale .zsync files'.format(reuse_count, len(stash)))
+    metrics.set_value('items', reuse_count, kind='zsync_reused')
+
+
+def _identity(path, file_index=None):
+    # Indexed files are identified by their size and content hash,
+    # anything else by size, mtime and a hash of the first 64 KiB
+    indexed = file_index.get(os.path.realpath(path)) if file_index is not None else None
+    if indexed is not None:
+        return '{}-{}'.format(indexed[0], indexed[2])
+
+    stat = os.stat(path)
+    with open(path, 'rb') as f:
+        head = f.read(65536)
+    return '{}-{}-{}'.format(stat.st_size, stat.st_mtime_ns, hashlib.sha1(head).hexdigest())
+
+
+def plan(config_yaml, link_plan, link_stats):
+    # Report what update() would do after the planned links were applied
+    if not config_yaml['a3sync'].get('native_zsync', True):
+        click.echo('ArmA3Sync repo: full rebuild')
+        return
+    # Files that are not linked yet will need a .zsync file as well
+    outdated = len(_outdated_zsync(config_yaml['a3sync']['directory'], link_plan)) + link_stats['created']
+    if outdated or any(link_stats.values()):
+        click.echo('ArmA3Sync repo: rebuild, up to {} .zsync files to generate'.format(outdated))
+    else:
+        click.echo('ArmA3Sync repo: unchanged')
 
-        for f in files:
-            if f.endswith('.zsync'):
-                cache_count += 1
-                shutil.copy(os.path.join(root, f), os.path.join(temp_dir, f))
-
-    print('Cached .zsync files:', cache_count)
-
-    # Wipe current repo, to be recreated below
-    for filename in os.listdir(output_dir):
-        if filename.startswith('@'):
-            shutil.rmtree(os.path.join(output_dir, filename))
-
-    # Create symlinks to all mods used
-    for mod in mods:
-        _create_mod_link(
-            os.path.join(config_yaml['mod_dir_full'], mod['published_file_id']),
-            os.path.join(output_dir, mod['folder_name'])
-        )
-    # Handle external mods
-    external_addon_dir = config_yaml['external_addon_dir']
-    if os.path.isdir(external_addon_dir):
-        for filename in os.listdir(external_addon_dir):
-            out_path = os.path.join(output_dir, _filename(filename))
-            if not os.path.exists(out_path):
-                _create_mod_link(os.path.join(external_addon_dir, filename), out_path)
-            else:
-                _log('ERR: Conflicting external addon "{}"'.format(filename), e=True)
-
-    # Retrieve stored .zsync files
-    print('Reusing cached .zsync files')
-    uncache_count = 0
-    for root, dirs, files in os.walk(output_dir):
-        if 'zsync-temp' in root:
-            continue
 
-        temp_dir = os.path.join(zsync_storage, os.path.relpath(root, output_dir))
+def update(mods, config_yaml, link_plan=None, link_stats=None):
+    # Returns False if the ArmA3Sync build failed
+    output_dir = config_yaml['a3sync']['directory']
 
+    if config_yaml['a3sync'].get('native_zsync', True) and link_plan is not None:
+        paths = _outdated_zsync(output_dir, link_plan)
+        stage = staging.stage_dir(config_yaml, 'a3sync')
+        if stage:
+            paths = _reuse_zsync(paths, output_dir, staging.build_path(stage, create=False))
+        click.echo('Generating .zsync files: {}'.format(len(paths)))
+        generated = zsync.generate_all(paths)
+        metrics.set_value('items', generated, kind='zsync_generated')
+
+        if not generated and link_stats is not None and not any(link_stats.values()):
+            click.echo('ArmA3Sync repo unchanged, skipping build')
+            return True
+
+    return subprocess.call(['java', '-jar',
+                            config_yaml['a3sync']['path_to_jar'],
+                            '-build', config_yaml['a3sync']['repo_name']]) == 0
+
+
+def _outdated_zsync(output_dir, link_plan):
+    # Only files that are new or changed since their .zsync was written need hashing
+    paths = []
+    for folder_name, input_path in link_plan['mods'].items():
+        for entry in get_manifest(input_path):
+            path = os.path.join(output_dir, folder_name, entry.link_path)
+            if not entry.is_dir and os.path.exists(path) and zsync.needs_update(path):
+                paths.append(path)
+    return paths
+
+
+def _reuse_zsync(paths, output_dir, previous_dir):
+    # The previous generation already has .zsync files for whatever changed in it,
+    # files are matched by the workshop file they link to, so renamed mods are found as well.
+    # Returns the paths that still need one generated
+    outdated = []
+    previous_links = None
+    for path in paths:
+        if not os.path.islink(path):
+            outdated.append(path)
+            continue
+        target = os.readlink(path)
+        previous = os.path.join(previous_dir, os.path.relpath(path, output_dir))
+        if not (os.path.islink(previous) and os.readlink(previous) == target):
+            if previous_links is None:
+                previous_links = _zsync_links(previous_dir)
+            previous = previous_links.get(target)
+
+        if previous and os.path.exists(previous + '.zsync') and not zsync.needs_update(previous):
+            if os.path.lexists(path + '.zsync'):
+                os.remove(path + '.zsync')
+            os.link(previous + '.zsync', path + '.zsync')
+        else:
+            outdated.append(path)
+    return outdated
+
+
+def _zsync_links(directory):
+    # Maps the link targets of every linked file with a .zsync file to the link
+    links = {}
+    for root, dirs, files in os.walk(directory):
         for f in files:
-            zsync = f +'.zsync'
-            zsync_path = os.path.join(temp_dir, zsync)
-            if os.path.exists(zsync_path):
-                uncache_count += 1
-                shutil.copy(zsync_path, os.path.join(root, zsync))
-            else:
-                print('Cache miss:', zsync_path)
-    shutil.rmtree(zsync_storage)
-    print('Reused .zsync files:', uncache_count)
-
-    subprocess.call(['java', '-jar',
-                     config_yaml['a3sync']['path_to_jar'],
-                     '-build', config_yaml['a3sync']['repo_name']])
+            path = os.path.join(root, f)[:-len('.zsync')]
+            if f.endswith('.zsync') and os.path.islink(path):
+                links[os.readlink(path)] = path
+    return links
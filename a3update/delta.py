@@ -0,0 +1,222 @@
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tarfile
+import time
+import click
+from a3update import manifest as manifests, workshop
+from a3update.a3update import _log
+from a3update.files import atomic_write, save_json
+
+# A bundle is a tar archive holding manifest.json and objects/<sha1> for every file whose
+# content was not part of the manifest it was exported since. The manifest lists every
+# file of the modset by its path relative to mod_dir_full, so a replica can tell which
+# files it already has, even if they moved, and which ones it needs from the bundle
+VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+OBJECTS_DIR = 'objects'
+SHA1_PATTERN = re.compile(r'[0-9a-f]{40}')
+
+
+def manifest(mods, file_index):
+    # Mods that were never indexed are left out, a replica would consider them installed
+    files = {}
+    included = []
+    for mod in mods:
+        rows = file_index.mod_files(mod['published_file_id'])
+        if not rows:
+            _log('WARN: {} ({}) is not installed, leaving it out'.format(mod['name'], mod['published_file_id']),
+                 e=True)
+            continue
+        included.append({k: mod[k] for k in ('published_file_id', 'name', 'folder_name', 'time_updated',
+                                             'file_size')})
+        for path, size, mtime, sha1 in rows:
+            files[path.replace(os.sep, '/')] = {'size': size, 'mtime': mtime, 'sha1': sha1}
+    return {'version': VERSION, 'created': time.time(), 'mods': included, 'files': files}
+
+
+def manifest_id(m):
+    # Identifies the content of a manifest, independent of mtimes and when it was created
+    return hashlib.sha1(json.dumps({path: f['sha1'] for path, f in m['files'].items()},
+                                   sort_keys=True).encode()).hexdigest()
+
+
+def load_manifest(path):
+    # Reads a manifest written next to a bundle, or the one inside a bundle
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path, 'r:*') as tar:
+            return json.load(tar.extractfile(MANIFEST_NAME))
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def export(mods, file_index, bundle_path, previous=None, compress=False):
+    # Writes the bundle and its manifest, named like the bundle with a .json extension.
+    # Returns the manifest, the number of objects and their size in bytes
+    current = manifest(mods, file_index)
+    current['since'] = manifest_id(previous) if previous else None
+    known = {f['sha1'] for f in previous['files'].values()} if previous else set()
+
+    # Content shared by several files is bundled once
+    objects = {}
+    for path, f in sorted(current['files'].items()):
+        if f['sha1'] not in known and f['sha1'] not in objects:
+            objects[f['sha1']] = (path, f['size'])
+    size = sum(s for _, s in objects.values())
+    click.echo('Bundling {} of {} files, {} bytes'.format(len(objects), len(current['files']), size))
+
+    data = json.dumps(current).encode()
+    with atomic_write(bundle_path, 'wb') as f, tarfile.open(fileobj=f, mode='w:gz' if compress else 'w') as tar:
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(data)
+        info.mtime = int(current['created'])
+        tar.addfile(info, io.BytesIO(data))
+        for sha1, (path, _) in objects.items():
+            tar.add(os.path.join(file_index.mod_dir_full, *path.split('/')),
+                    arcname='{}/{}'.format(OBJECTS_DIR, sha1), recursive=False)
+
+    manifest_path = os.path.splitext(bundle_path)[0] + '.json'
+    with atomic_write(manifest_path) as f:
+        f.write(data.decode())
+    click.echo('Wrote {} and {}'.format(bundle_path, manifest_path))
+    return current, len(objects), size
+
+
+def apply(bundle_path, file_index, mod_dir):
+    # Brings the workshop items in mod_dir_full to the state of the bundle's manifest and
+    # records them as installed, so SteamCMD does not download them again.
+    # Files are taken from the bundle or, if their content is already on this node, copied.
+    # Returns the number of files extracted, copied and removed
+    mod_dir_full = file_index.mod_dir_full
+    with tarfile.open(bundle_path, 'r:*') as tar:
+        current = json.load(tar.extractfile(MANIFEST_NAME))
+        if current.get('version') != VERSION:
+            raise click.ClickException('Unsupported delta bundle version {}'.format(current.get('version')))
+        _validate(current)
+        objects = {member.name[len(OBJECTS_DIR) + 1:]: member for member in tar.getmembers()
+                   if member.name.startswith(OBJECTS_DIR + '/')}
+
+        # Index what is on disk, unchanged files and files that only moved are found by their hash
+        mod_ids = [mod['published_file_id'] for mod in current['mods']]
+        file_index.update(mod_ids, folder_names={mod['published_file_id']: mod.get('folder_name')
+                                                 for mod in current['mods']})
+        outdated = []
+        local = {}
+        for path, f in sorted(current['files'].items()):
+            indexed = file_index.get(os.path.join(*path.split('/')))
+            if indexed is not None and indexed[2] == f['sha1']:
+                continue
+            outdated.append((path, f))
+            if f['sha1'] not in objects and f['sha1'] not in local:
+                local[f['sha1']] = _find_local(file_index, f)
+        missing = [path for path, f in outdated if f['sha1'] not in objects and local[f['sha1']] is None]
+        if missing:
+            raise click.ClickException('{} files are neither in the bundle nor on this node, '
+                                       'it was exported since a different manifest: {}'.format(len(missing),
+                                                                                              missing[0]))
+        click.echo('Updating {} of {} files'.format(len(outdated), len(current['files'])))
+
+        # Everything is staged before the first file is replaced, local copies could be replaced as well
+        staging_dir = os.path.join(mod_dir_full, '.delta')
+        if os.path.exists(staging_dir):
+            shutil.rmtree(staging_dir)
+        os.makedirs(staging_dir)
+        destinations = {}
+        for path, f in outdated:
+            destinations.setdefault(f['sha1'], []).append((path, f))
+        extracted = copied = 0
+        for sha1 in destinations:
+            staged = os.path.join(staging_dir, sha1)
+            if sha1 in objects:
+                _extract(tar, objects[sha1], staged, sha1)
+                extracted += len(destinations[sha1])
+            else:
+                shutil.copyfile(local[sha1], staged)
+                copied += len(destinations[sha1])
+
+    for sha1, paths in destinations.items():
+        staged = os.path.join(staging_dir, sha1)
+        for i, (path, f) in enumerate(paths):
+            out_path = os.path.join(mod_dir_full, *path.split('/'))
+            if os.path.isdir(out_path) and not os.path.islink(out_path):
+                shutil.rmtree(out_path)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            temp_path = out_path + '.tmp'
+            if i < len(paths) - 1:
+                shutil.copyfile(staged, temp_path)
+            else:
+                os.replace(staged, temp_path)
+            os.utime(temp_path, (f['mtime'], f['mtime']))
+            os.replace(temp_path, out_path)
+    shutil.rmtree(staging_dir)
+
+    # Files that are not part of the manifest are stale, including ignored ones
+    removed = 0
+    for published_file_id in mod_ids:
+        input_path = os.path.join(mod_dir_full, published_file_id)
+        os.makedirs(input_path, exist_ok=True)
+        for root, dirs, files in os.walk(input_path, topdown=False):
+            for name in files:
+                path = os.path.relpath(os.path.join(root, name), mod_dir_full).replace(os.sep, '/')
+                if path not in current['files']:
+                    os.remove(os.path.join(root, name))
+                    removed += 1
+            if root != input_path and not os.listdir(root):
+                os.rmdir(root)
+
+    acf = workshop.load_acf(mod_dir)
+    installed = acf.setdefault('AppWorkshop', {}).setdefault('WorkshopItemsInstalled', {})
+    for mod in current['mods']:
+        item = installed.setdefault(mod['published_file_id'], {})
+        item['size'] = str(mod['file_size'])
+        item['timeupdated'] = str(mod['time_updated'])
+    workshop.save_acf(mod_dir, acf)
+    # Scans made before the files were replaced are stale
+    manifests.clear()
+
+    manifest_path = os.path.join(mod_dir, 'delta-manifest.json')
+    save_json(manifest_path, current)
+    click.echo('Extracted {} files, copied {} files, removed {} stale files'.format(extracted, copied, removed))
+    return extracted, copied, removed
+
+
+def _validate(current):
+    # Ids and paths of the manifest become paths on disk, so anything that
+    # could point outside of the bundle's own workshop items is refused
+    mod_ids = set()
+    for mod in current['mods']:
+        published_file_id = mod['published_file_id']
+        if not isinstance(published_file_id, str) or not published_file_id.isdigit():
+            raise click.ClickException('Invalid workshop item id {!r} in delta bundle'.format(published_file_id))
+        mod_ids.add(published_file_id)
+    for path, f in current['files'].items():
+        parts = path.split('/')
+        if os.path.isabs(path) or os.path.splitdrive(path)[0] or len(parts) < 2 or parts[0] not in mod_ids \
+                or any(part in ('', '.', '..') or os.sep in part or (os.altsep and os.altsep in part)
+                       for part in parts):
+            raise click.ClickException('Invalid path {!r} in delta bundle'.format(path))
+        if not isinstance(f['sha1'], str) or not SHA1_PATTERN.fullmatch(f['sha1']):
+            raise click.ClickException('Invalid hash {!r} for {} in delta bundle'.format(f['sha1'], path))
+
+
+def _find_local(file_index, f):
+    for path in file_index.find(f['sha1']):
+        path = os.path.join(file_index.mod_dir_full, path)
+        if os.path.isfile(path) and os.path.getsize(path) == f['size']:
+            return path
+    return None
+
+
+def _extract(tar, member, path, sha1):
+    # Objects are verified while they are written, a file that changed while it was
+    # bundled would otherwise be installed under the wrong hash
+    digest = hashlib.sha1()
+    with tar.extractfile(member) as src, open(path, 'wb') as dst:
+        for chunk in iter(lambda: src.read(1048576), b''):
+            digest.update(chunk)
+            dst.write(chunk)
+    if digest.hexdigest() != sha1:
+        raise click.ClickException('Corrupt object {} in delta bundle'.format(sha1))
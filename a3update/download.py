@@ -0,0 +1,201 @@
+import heapq
+import os
+import re
+import shutil
+import subprocess
+import time
+import click
+from concurrent.futures import ThreadPoolExecutor
+from pysteamcmdwrapper import SteamCMD_command
+from a3update.a3update import ARMA_APPID, _log
+from a3update import workshop
+from a3update.reconcile import _reflink
+
+SUCCESS_PATTERN = re.compile(r'Success\. Downloaded item (\d+)')
+ERROR_PATTERN = re.compile(r'ERROR! Download item (\d+) failed \(([^)]*)\)')
+
+
+def schedule(mods, workers):
+    # Hand the largest remaining mod to the least loaded worker,
+    # so the big mods are spread out instead of piling up in one worker
+    buckets = [[] for _ in range(workers)]
+    loads = [(0, i) for i in range(workers)]
+    for mod in sorted(mods, key=lambda m: m['file_size'], reverse=True):
+        load, i = heapq.heappop(loads)
+        buckets[i].append(mod)
+        heapq.heappush(loads, (load + mod['file_size'], i))
+    return [bucket for bucket in buckets if bucket]
+
+
+def run_steamcmd(steam_cmd, command):
+    # Same invocation as SteamCMD.execute, but the output is kept for parsing
+    params = (
+        steam_cmd.exe,
+        '+login {} {}'.format(steam_cmd._uname, steam_cmd._passw),
+        command.get_cmd(),
+        '+quit',
+    )
+    process = subprocess.Popen(' '.join(params), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               universal_newlines=True, errors='replace')
+    output = []
+    for line in process.stdout:
+        click.echo(line, nl=False)
+        output.append(line)
+    process.wait()
+    return ''.join(output)
+
+
+def parse_results(output):
+    succeeded = set(SUCCESS_PATTERN.findall(output))
+    failed = {published_file_id: reason for published_file_id, reason in ERROR_PATTERN.findall(output)}
+    return succeeded, failed
+
+
+def download(run, mods, mod_dir, workers=1, max_tries=5, backoff=5, max_command_length=4000):
+    # run(command) executes a SteamCMD_command and returns its output, mods with
+    # a true 'validate' are validated by SteamCMD.
+    # Returns the mods that still failed after max_tries attempts
+    options = {'max_tries': max_tries, 'backoff': backoff, 'max_command_length': max_command_length}
+    _recover(mod_dir)
+    if workers <= 1 or len(mods) <= 1:
+        failed = _download_queue(run, mods, mod_dir, **options)
+    else:
+        buckets = schedule(mods, workers)
+        worker_dirs = [os.path.join(mod_dir, 'workers', str(i)) for i in range(len(buckets))]
+        _log('Downloading {} workshop items with {} SteamCMD workers'.format(len(mods), len(buckets)))
+
+        with ThreadPoolExecutor(max_workers=len(buckets)) as executor:
+            futures = [executor.submit(_worker, run, bucket, mod_dir, worker_dir, options)
+                       for bucket, worker_dir in zip(buckets, worker_dirs)]
+
+        # Merge the per worker manifests once every worker is done, failed items keep their entry
+        failed = []
+        acf = workshop.load_acf(mod_dir)
+        for future in futures:
+            worker_failed, worker_acf, swapped_ids = future.result()
+            failed += worker_failed
+            workshop.copy_acf_items(worker_acf, acf, swapped_ids)
+        workshop.save_acf(mod_dir, acf)
+
+    if failed:
+        _log('ERR: {} workshop items failed to download'.format(len(failed)), e=True)
+        for mod in failed:
+            click.echo('{} ({}): {}'.format(mod['name'], mod['published_file_id'], mod['error']), err=True)
+    return failed
+
+
+def _worker(run, mods, mod_dir, worker_dir, options):
+    # Items are downloaded into a copy in the worker, so the installed ones stay
+    # in place and linked while SteamCMD runs, and swapped in once they succeeded.
+    # Returns the failed mods, the worker's manifest and the ids of the items swapped in
+    mod_dir_full = workshop.content_dir(mod_dir)
+    worker_dir_full = workshop.content_dir(worker_dir)
+    os.makedirs(worker_dir_full)
+
+    # Seed the worker with copies of the installed items so SteamCMD only patches what changed.
+    # They are not hard linked, SteamCMD may repair a file in place while validating it.
+    # Its manifest is seeded with their current state
+    published_file_ids = [mod['published_file_id'] for mod in mods]
+    for published_file_id in published_file_ids:
+        path = os.path.join(mod_dir_full, published_file_id)
+        if os.path.isdir(path):
+            shutil.copytree(path, os.path.join(worker_dir_full, published_file_id), symlinks=True,
+                            copy_function=_clone_or_copy)
+    workshop.save_acf(worker_dir, workshop.copy_acf_items(workshop.load_acf(mod_dir), {
+        'AppWorkshop': {'appid': str(ARMA_APPID)}
+    }, published_file_ids))
+
+    failed = _download_queue(run, mods, worker_dir, **options)
+    failed_ids = {mod['published_file_id'] for mod in failed}
+    replaced_dir = os.path.join(worker_dir, 'replaced')
+    os.makedirs(replaced_dir)
+    os.makedirs(mod_dir_full, exist_ok=True)
+    swapped_ids = []
+    for published_file_id in published_file_ids:
+        path = os.path.join(worker_dir_full, published_file_id)
+        if published_file_id in failed_ids or not os.path.isdir(path):
+            continue
+        out_path = os.path.join(mod_dir_full, published_file_id)
+        if os.path.isdir(out_path):
+            os.rename(out_path, os.path.join(replaced_dir, published_file_id))
+        os.rename(path, out_path)
+        swapped_ids.append(published_file_id)
+    acf = workshop.load_acf(worker_dir)
+    shutil.rmtree(worker_dir)
+    return failed, acf, swapped_ids
+
+
+def _recover(mod_dir):
+    # A run that was killed leaves its workers behind. Their items are only copies unless
+    # the run stopped while swapping one in, then it is moved back to where it belongs
+    workers_dir = os.path.join(mod_dir, 'workers')
+    if not os.path.isdir(workers_dir):
+        return
+    mod_dir_full = workshop.content_dir(mod_dir)
+    for name in os.listdir(workers_dir):
+        worker_dir = os.path.join(workers_dir, name)
+        for items_dir in (workshop.content_dir(worker_dir), os.path.join(worker_dir, 'replaced')):
+            if not os.path.isdir(items_dir):
+                continue
+            for published_file_id in os.listdir(items_dir):
+                out_path = os.path.join(mod_dir_full, published_file_id)
+                if not os.path.exists(out_path):
+                    click.echo('Recovering workshop item {} from {}'.format(published_file_id, items_dir))
+                    os.makedirs(mod_dir_full, exist_ok=True)
+                    os.rename(os.path.join(items_dir, published_file_id), out_path)
+        shutil.rmtree(worker_dir)
+
+
+def _clone_or_copy(src, dst):
+    # Copy-on-write clones cost no space where the filesystem supports them
+    try:
+        _reflink(src, dst)
+    except (ImportError, OSError):
+        shutil.copy2(src, dst)
+
+
+def _download_queue(run, mods, install_dir, max_tries, backoff, max_command_length):
+    # Every item is tracked on its own, only the items that failed are queued
+    # again after an exponential backoff instead of replaying the whole batch
+    pending = [(0, mod) for mod in mods]
+    attempts = {}
+    failed = []
+    while pending:
+        now = time.time()
+        ready = [mod for retry_at, mod in pending if retry_at <= now]
+        if not ready:
+            time.sleep(min(retry_at for retry_at, mod in pending) - now)
+            continue
+
+        ws_update_command = SteamCMD_command()
+        ws_update_command.force_install_dir(install_dir)
+        batch = []
+        for mod in ready:
+            command_length = len(ws_update_command.get_cmd()) + len(_download_item_command(mod))
+            if batch and command_length > max_command_length:
+                break
+            ws_update_command.workshop_download_item(ARMA_APPID, mod['published_file_id'],
+                                                     validate=mod.get('validate', False))
+            batch.append(mod)
+        batch_ids = {mod['published_file_id'] for mod in batch}
+        pending = [(retry_at, mod) for retry_at, mod in pending if mod['published_file_id'] not in batch_ids]
+
+        succeeded, errors = parse_results(run(ws_update_command))
+        for mod in batch:
+            published_file_id = mod['published_file_id']
+            if published_file_id in succeeded:
+                continue
+            attempts[published_file_id] = attempts.get(published_file_id, 0) + 1
+            error = errors.get(published_file_id, 'No result reported by SteamCMD')
+            if attempts[published_file_id] >= max_tries:
+                failed.append(dict(mod, error=error))
+            else:
+                delay = backoff * 2 ** (attempts[published_file_id] - 1)
+                click.echo('Download of {} failed ({}), retrying in {}s'.format(published_file_id, error, delay))
+                pending.append((time.time() + delay, mod))
+    return failed
+
+
+def _download_item_command(mod):
+    return ' +workshop_download_item {} {}{}'.format(ARMA_APPID, mod['published_file_id'],
+                                                    ' validate' if mod.get('validate', False) else '')
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import click
+from a3update import metrics
+from a3update.manifest import get_manifest
+from a3update.pool import process_pool
+
+
+# Persistent index of every file in mod_dir_full, mapping its path
+# (relative to mod_dir_full) to its size, mtime and SHA-1
+class FileIndex:
+    def __init__(self, path, mod_dir_full):
+        self.path = path
+        self.mod_dir_full = mod_dir_full
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files '
+                        '(path TEXT PRIMARY KEY, mod TEXT, size INTEGER, mtime REAL, sha1 TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_mod ON files (mod)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_sha1 ON files (sha1)')
+        self.db.commit()
+
+    def update(self, published_file_ids, workers=None, folder_names=None, keep=()):
+        # Only files whose size or mtime changed are hashed again,
+        # returns the ids of the mods that had any file added, changed or removed.
+        # folder_names maps ids to the folders they are linked as, for path scoped
+        # ignore rules of mods that were not scanned by a link plan.
+        # Mods in keep are part of the modset but keep their rows as they are
+        keep = set(keep)
+        published_file_ids = set(published_file_ids) - keep
+        changed_mods = set()
+        to_hash = []
+        with self.lock:
+            for published_file_id in published_file_ids:
+                input_path = os.path.join(self.mod_dir_full, published_file_id)
+                if not os.path.isdir(input_path):
+                    continue
+
+                known = {row[0]: row[1:] for row in self.db.execute(
+                    'SELECT path, size, mtime FROM files WHERE mod = ?', (published_file_id,))}
+                for entry in get_manifest(input_path, (folder_names or {}).get(published_file_id)):
+                    if entry.is_dir:
+                        continue
+                    path = os.path.join(published_file_id, entry.path)
+                    if known.pop(path, None) != (entry.size, entry.mtime):
+                        to_hash.append((path, published_file_id, entry.size, entry.mtime))
+                if known:
+                    self.db.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in known])
+                    changed_mods.add(published_file_id)
+
+            # Drop mods that are no longer part of the modset
+            for (published_file_id,) in self.db.execute('SELECT DISTINCT mod FROM files').fetchall():
+                if published_file_id not in published_file_ids and published_file_id not in keep:
+                    self.db.execute('DELETE FROM files WHERE mod = ?', (published_file_id,))
+
+            if to_hash:
+                click.echo('Hashing {} new or changed files'.format(len(to_hash)))
+                with process_pool(workers) as executor:
+                    hashes = executor.map(_sha1, [os.path.join(self.mod_dir_full, f[0]) for f in to_hash],
+                                          chunksize=16)
+                    self.db.executemany('INSERT OR REPLACE INTO files (path, mod, size, mtime, sha1) '
+                                        'VALUES (?, ?, ?, ?, ?)', [f + (h,) for f, h in zip(to_hash, hashes)])
+                changed_mods.update(f[1] for f in to_hash)
+            self.db.commit()
+        metrics.set_value('items', len(to_hash), kind='files_hashed')
+        return changed_mods
+
+    def get(self, path):
+        # path may be absolute, returns (size, mtime, sha1) or None for files outside of the index
+        if os.path.isabs(path):
+            path = os.path.relpath(path, os.path.realpath(self.mod_dir_full))
+            if path.startswith(os.pardir):
+                return None
+        with self.lock:
+            return self.db.execute('SELECT size, mtime, sha1 FROM files WHERE path = ?', (path,)).fetchone()
+
+    def find(self, sha1):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT path FROM files WHERE sha1 = ?', (sha1,))]
+
+    def mod_files(self, published_file_id):
+        with self.lock:
+            return self.db.execute('SELECT path, size, mtime, sha1 FROM files WHERE mod = ? ORDER BY path',
+                                   (published_file_id,)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def _sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
@@ -0,0 +1,27 @@
+import json
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path, mode='w', **kwargs):
+    # The file is written next to path and replaced in one rename,
+    # so readers and a killed run never leave a partly written file behind
+    temp_path = path + '.tmp'
+    with open(temp_path, mode, **kwargs) as f:
+        yield f
+    os.replace(temp_path, path)
+
+
+def load_json(path, default=None):
+    # State files that are missing or unreadable count as empty
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    with atomic_write(path) as f:
+        json.dump(data, f)
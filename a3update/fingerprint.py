@@ -0,0 +1,38 @@
+import hashlib
+import json
+import os
+from a3update.files import load_json, save_json
+from a3update.manifest import get_manifest
+
+
+def compute(mods, link_plan, *configs):
+    # Fingerprint of everything a publisher reads: the ordered mod list with the
+    # time_updated of every item, the size and mtime of every linked file, which also
+    # covers the external addons, and the config sections the publisher depends on
+    sha1 = hashlib.sha1()
+    sha1.update(json.dumps([(mod['published_file_id'], mod['name'], mod['time_updated']) for mod in mods])
+                .encode())
+    for folder_name, input_path in sorted(link_plan['mods'].items()):
+        sha1.update(json.dumps([folder_name, input_path]).encode())
+        for entry in get_manifest(input_path):
+            sha1.update('{}\0{}\0{}\0{}\n'.format(entry.link_path, entry.is_dir, entry.size, entry.mtime).encode())
+    sha1.update(json.dumps(configs, sort_keys=True, default=str).encode())
+    return sha1.hexdigest()
+
+
+def unchanged(state_path, publisher, fingerprint, output_path=None):
+    # output_path is checked as well, so deleted outputs are published again
+    if output_path is not None and not os.path.exists(output_path):
+        return False
+    return load_json(state_path, {}).get(publisher) == fingerprint
+
+
+def record(state_path, publisher, fingerprint):
+    state = load_json(state_path, {})
+    state[publisher] = fingerprint
+    save_json(state_path, state)
+
+
+def clear(state_path):
+    if os.path.exists(state_path):
+        os.remove(state_path)
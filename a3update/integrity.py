@@ -0,0 +1,59 @@
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+import click
+from a3update.file_index import _sha1
+from a3update.files import load_json, save_json
+from a3update.manifest import get_manifest
+
+
+def drifted(mods, file_index, sample_files=0):
+    # Compares the files of every mod with the sizes and mtimes recorded in the file index
+    # after the last run, and rehashes up to sample_files of them.
+    # Returns the mods whose content no longer matches, mods that were never indexed are skipped
+    def check(mod):
+        published_file_id = mod['published_file_id']
+        indexed = {row[0]: row[1:] for row in file_index.mod_files(published_file_id)}
+        if not indexed:
+            return None
+        input_path = os.path.join(file_index.mod_dir_full, published_file_id)
+        if not os.path.isdir(input_path):
+            return 'missing'
+
+        # Scanned under the mod's folder name, like the scan the index was built from
+        on_disk = {os.path.join(published_file_id, entry.path): (entry.size, entry.mtime)
+                   for entry in get_manifest(input_path, mod['folder_name']) if not entry.is_dir}
+        if on_disk.keys() != indexed.keys():
+            return '{} files added or removed'.format(len(on_disk.keys() ^ indexed.keys()))
+        changed = [path for path, (size, mtime) in on_disk.items() if (size, mtime) != indexed[path][:2]]
+        if changed:
+            return '{} files changed'.format(len(changed))
+
+        for path in random.sample(sorted(indexed), min(sample_files, len(indexed))):
+            if _sha1(os.path.join(file_index.mod_dir_full, path)) != indexed[path][2]:
+                return 'content of {} changed'.format(path)
+        return None
+
+    with ThreadPoolExecutor() as executor:
+        results = list(executor.map(check, mods))
+
+    drift = []
+    for mod, reason in zip(mods, results):
+        if reason is not None:
+            click.echo('Integrity check failed for {} ({}): {}'.format(mod['name'], mod['published_file_id'], reason))
+            drift.append(mod)
+    return drift
+
+
+def full_validation_due(state_path, interval):
+    # interval is in seconds, 0 disables periodic full validation
+    if not interval:
+        return False
+    return time.time() - load_json(state_path, {}).get('last_full_validation', 0) >= interval
+
+
+def record_full_validation(state_path):
+    state = load_json(state_path, {})
+    state['last_full_validation'] = time.time()
+    save_json(state_path, state)
@@ -0,0 +1,74 @@
+import os
+from collections import namedtuple
+from a3update.a3update import _filename, _is_ignored_file
+
+# path is relative to the mod folder, link_path is the sanitized name it is linked as
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'link_path', 'is_dir', 'size', 'mtime', 'is_bikey'])
+
+_MANIFESTS = {}
+_IGNORED = {}
+_FOLDER_NAMES = {}
+
+
+def get_manifest(input_path, folder_name=None):
+    # Every mod folder is only scanned once per run, linking,
+    # key handling and the repo publishers all share the result.
+    # folder_name is the folder the mod is linked as, used by path scoped ignore rules.
+    # A mod is scanned again when it is asked for under a different folder name,
+    # callers that pass none get the cached scan, whichever folder name it was made for
+    if input_path not in _MANIFESTS or (folder_name is not None and _FOLDER_NAMES[input_path] != folder_name):
+        _MANIFESTS[input_path], _IGNORED[input_path] = scan(input_path, folder_name)
+        _FOLDER_NAMES[input_path] = folder_name
+    return _MANIFESTS[input_path]
+
+
+def is_verbatim(input_path):
+    # True when a mod can be linked as a whole, nothing in it is ignored and no name needs sanitizing
+    entries = get_manifest(input_path)
+    return not _IGNORED[input_path] and all(entry.link_path == entry.path for entry in entries)
+
+
+def ignored_count():
+    return sum(_IGNORED.values())
+
+
+def clear(keep=()):
+    # keep lists input paths whose manifests are still current
+    for input_path in list(_MANIFESTS):
+        if input_path not in keep:
+            del _MANIFESTS[input_path]
+            del _IGNORED[input_path]
+            del _FOLDER_NAMES[input_path]
+
+
+def scan(input_path, folder_name=None):
+    entries = []
+    ignored = _scan(input_path, '', '', folder_name or '', entries)
+    return entries, ignored
+
+
+def bikeys(input_path):
+    return [os.path.join(input_path, entry.path) for entry in get_manifest(input_path) if entry.is_bikey]
+
+
+def _scan(input_path, path, link_path, folder_name, entries):
+    ignored = 0
+    with os.scandir(os.path.join(input_path, path)) as it:
+        for entry in it:
+            entry_path = os.path.join(path, entry.name)
+            entry_link_path = os.path.join(link_path, _filename(entry.name))
+            # Path scoped rules may be written against the original or the sanitized name
+            ignore_paths = {'/'.join([folder_name] + p.split(os.sep)) for p in (entry_path, entry_link_path)}
+            if any(_is_ignored_file(entry.name, p) for p in ignore_paths):
+                # Ignored folders are pruned without being descended into
+                ignored += 1
+                continue
+
+            if entry.is_dir():
+                entries.append(ManifestEntry(entry_path, entry_link_path, True, 0, 0, False))
+                ignored += _scan(input_path, entry_path, entry_link_path, folder_name, entries)
+            else:
+                stat = entry.stat()
+                entries.append(ManifestEntry(entry_path, entry_link_path, False, stat.st_size, stat.st_mtime,
+                                             entry.name.lower().endswith('.bikey')))
+    return ignored
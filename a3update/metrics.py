@@ -0,0 +1,80 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from a3update.files import atomic_write
+
+PREFIX = 'a3update'
+
+# (name, sorted label items) -> value
+_VALUES = {}
+_LOCK = threading.Lock()
+_HELP = {
+    'phase_seconds': 'Wall time spent in each phase of the last run',
+    'items': 'Item counts of the last run',
+    'queued_bytes': 'Published size of each workshop item downloaded or validated in the last run',
+    'links': 'Link operations per target in the last run',
+    'cache_requests': 'Cache lookups of the last run by cache and result',
+    'disk_bytes': 'Bytes used by workshop items in use, orphaned and reclaimed in the last run',
+    'link_modes': 'Mod folders per target and link mode in the last run',
+    'syscalls_saved': 'Minimum filesystem calls per target saved by directory links in the last run',
+    'last_run_timestamp_seconds': 'Time the last run finished',
+}
+
+
+def reset():
+    _VALUES.clear()
+
+
+@contextmanager
+def phase(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        inc('phase_seconds', time.perf_counter() - start, phase=name, **labels)
+
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _LOCK:
+        _VALUES[key] = _VALUES.get(key, 0) + value
+
+
+def set_value(name, value, **labels):
+    _VALUES[(name, tuple(sorted(labels.items())))] = value
+
+
+def get(name, **labels):
+    return _VALUES.get((name, tuple(sorted(labels.items()))), 0)
+
+
+def write(json_path=None, prometheus_path=None):
+    set_value('last_run_timestamp_seconds', time.time())
+    if json_path:
+        report = {}
+        for (name, labels), value in sorted(_VALUES.items()):
+            report.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        with atomic_write(json_path) as f:
+            f.write(json.dumps(report, indent=2))
+    if prometheus_path:
+        # node_exporter may read the file at any time
+        with atomic_write(prometheus_path) as f:
+            f.write(_prometheus())
+
+
+def _prometheus():
+    # Textfile collector format, every value is exported as a gauge
+    lines = []
+    for name in sorted({name for name, _ in _VALUES}):
+        metric = '{}_{}'.format(PREFIX, name)
+        if name in _HELP:
+            lines.append('# HELP {} {}'.format(metric, _HELP[name]))
+        lines.append('# TYPE {} gauge'.format(metric))
+        for (value_name, labels), value in sorted(_VALUES.items()):
+            if value_name != name:
+                continue
+            label_str = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in labels)
+            lines.append('{}{} {}'.format(metric, '{' + label_str + '}' if label_str else '', value))
+    return '\n'.join(lines) + '\n'
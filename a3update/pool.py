@@ -0,0 +1,10 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def process_pool(max_workers=None):
+    # Profiles are linked and published from threads, and forking while other threads
+    # hold locks can deadlock the child, so workers are started from a fresh process
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
@@ -0,0 +1,365 @@
+import fnmatch
+import os
+import shutil
+import stat
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import click
+from a3update import metrics, staging
+from a3update.a3update import _filename, _log
+from a3update.manifest import bikeys, get_manifest, ignored_count, is_verbatim
+
+# How a mod folder is materialized in a target, each mod uses the first mode in the
+# configured order that works for it, with symlink as the fallback:
+# dir      - one symlink to the whole mod, if no name in it needs sanitizing
+# reflink  - copy-on-write clones of every file, if the filesystem supports them
+# hardlink - hard links to every file, if the target is on the same filesystem
+# symlink  - a tree of real folders with a symlink per file
+LINK_MODES = ('dir', 'reflink', 'hardlink', 'symlink')
+DEFAULT_LINK_MODES = ('dir', 'symlink')
+# Linux FICLONE ioctl
+_FICLONE = 0x40049409
+
+# (mode, input device, output device) -> whether the mode works between them
+_SUPPORTED = {}
+
+
+def new_stats():
+    return {'created': 0, 'removed': 0, 'retargeted': 0}
+
+
+def log_stats(stats):
+    _log('Reconciled links: {created} created, {removed} removed, {retargeted} retargeted'.format(**stats))
+
+
+def plan(mods, config_yaml, file_index=None):
+    # Work out which folders and keys every target should contain, once per run,
+    # targets can query the file index passed along with the plan
+    link_plan = {'mods': {}, 'keys': {}, 'index': file_index,
+                 'modes': tuple(config_yaml.get('link_modes') or DEFAULT_LINK_MODES)}
+    installed = []
+    for mod in mods:
+        input_path = os.path.join(config_yaml['mod_dir_full'], mod['published_file_id'])
+        # Items that never downloaded have nothing to link
+        if not os.path.isdir(input_path):
+            _log('WARN: {} ({}) is not installed, leaving it out'.format(mod['name'], mod['published_file_id']),
+                 e=True)
+            continue
+        link_plan['mods'][mod['folder_name']] = input_path
+        installed.append(mod)
+
+    external_addon_dir = config_yaml['external_addon_dir']
+    if os.path.isdir(external_addon_dir):
+        for filename in os.listdir(external_addon_dir):
+            out_name = _filename(filename)
+            if out_name in link_plan['mods']:
+                _log('ERR: Conflicting external addon "{}"'.format(filename), e=True)
+            else:
+                link_plan['mods'][out_name] = os.path.join(external_addon_dir, filename)
+
+    # Scan every mod up front so the targets can be linked concurrently
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(get_manifest, link_plan['mods'].values(), link_plan['mods'].keys()))
+    click.echo('Ignored files/folders: {}'.format(ignored_count()))
+
+    if config_yaml['handle_keys']:
+        for mod in installed:
+            keys = bikeys(link_plan['mods'][mod['folder_name']])
+            if not keys:
+                _log('WARN: No bikeys found for: {}'.format(mod['name']), e=True)
+            for key in keys:
+                key_link = _filename(os.path.basename(key))
+                if key_link in link_plan['keys']:
+                    _log('WARN: Duplicate key: {}'.format(key_link), e=True)
+                else:
+                    link_plan['keys'][key_link] = key
+
+    return link_plan
+
+
+def apply(link_plan, targets, dry_run=False, only=None):
+    # Each target is a dict with the output 'path', an optional 'key_path',
+    # optional 'preserve' patterns for files that should not be pruned,
+    # optional 'prepare'/'finish' callbacks run around the reconciliation,
+    # an optional 'stage' directory, see publish(), and optional 'link_modes'
+    # it supports. Targets with preserve patterns are never linked as a whole.
+    # With dry_run nothing is changed, the stats count what would have been.
+    # only limits the folders whose trees are walked, stale folders are still removed.
+    # It is ignored for staged targets, their build generation is one or more runs
+    # behind the live one, so the unchanged folders need reconciling as well
+    def apply_target(target):
+        stats = new_stats()
+        path = build_path(target, dry_run)
+        target_only = None if target.get('stage') else only
+        if target.get('prepare') and not dry_run:
+            target['prepare'](path, link_plan)
+        desired = {}
+        for folder_name, input_path in link_plan['mods'].items():
+            # Folders not following the @ convention are never pruned, so refuse to overwrite them
+            public_path = os.path.join(target['path'], folder_name)
+            if not folder_name.startswith('@') and os.path.exists(public_path) \
+                    and not (target.get('stage') and staging.is_published(target['stage'], public_path)):
+                _log('ERR: Conflicting external addon "{}" in {}'.format(folder_name, target['path']), e=True)
+            else:
+                desired[folder_name] = input_path
+        modes = [mode for mode in link_plan.get('modes', DEFAULT_LINK_MODES)
+                 if mode in target.get('link_modes', LINK_MODES)]
+        mode_counts, saved = reconcile_mods(desired, path, stats, target.get('preserve', ()), dry_run, target_only,
+                                           modes)
+        if mode_counts:
+            click.echo('{}: {}{}'.format(target['path'], ', '.join(
+                '{} as {}'.format(n, mode) for mode, n in sorted(mode_counts.items())),
+                ', at least {} filesystem calls saved'.format(saved) if saved else ''))
+        for mode, n in mode_counts.items():
+            metrics.set_value('link_modes', n, path=target['path'], mode=mode)
+        metrics.set_value('syscalls_saved', saved, path=target['path'])
+        if dry_run and target.get('stage'):
+            staging.publish_links(target['stage'], target['path'], stats, desired, dry_run)
+        if target.get('key_path'):
+            reconcile_keys(link_plan['keys'], target['key_path'], stats, dry_run)
+        if target.get('finish') and not dry_run:
+            target['finish'](path, link_plan)
+        return stats
+
+    with ThreadPoolExecutor(max_workers=max(len(targets), 1)) as executor:
+        results = list(executor.map(apply_target, targets))
+
+    for target, stats in zip(targets, results):
+        click.echo('{}: {created} created, {removed} removed, {retargeted} retargeted'.format(target['path'], **stats))
+    return results
+
+
+def publish(targets):
+    # Staged targets are linked into their next generation by apply(), this makes
+    # them live with a single rename and links any added or removed mod folders
+    results = []
+    for target in targets:
+        stats = new_stats()
+        if target.get('stage'):
+            staging.flip(target['stage'], build_path(target))
+            staging.publish_links(target['stage'], target['path'], stats)
+            click.echo('{}: published, {created} created, {removed} removed, {retargeted} retargeted'.format(
+                target['path'], **stats))
+        results.append(stats)
+    return results
+
+
+def build_path(target, dry_run=False):
+    # The directory the mod folders of a target are reconciled in,
+    # dry runs compare with the live generation of staged targets
+    if not target.get('stage'):
+        return target['path']
+    if dry_run:
+        return staging.current_path(target['stage']) or target['path']
+    return staging.build_path(target['stage'])
+
+
+def reconcile_mods(desired, output_dir, stats, preserve=(), dry_run=False, only=None, modes=('symlink',)):
+    # desired maps output folder names to their source directories,
+    # any other @ folder in output_dir is considered stale.
+    # Returns how many mods were linked in each mode and the filesystem calls
+    # saved by linking mods as a whole, at least one per file or folder
+    for entry in _scandir(output_dir):
+        if entry.name.startswith('@') and entry.name not in desired:
+            _remove(entry, stats, dry_run)
+
+    mode_counts = Counter()
+    saved = 0
+    for folder_name, input_path in desired.items():
+        if only is not None and folder_name not in only:
+            continue
+        mode = select_mode(input_path, output_dir, modes, preserve, dry_run)
+        sync_tree(input_path, os.path.join(output_dir, folder_name), stats, preserve, dry_run, mode)
+        mode_counts[mode] += 1
+        if mode == 'dir':
+            saved += len(get_manifest(input_path)) - 1
+    return mode_counts, saved
+
+
+def select_mode(input_path, output_dir, modes, preserve=(), dry_run=False):
+    for mode in modes:
+        if mode == 'dir' and not preserve and is_verbatim(input_path):
+            return mode
+        if mode in ('reflink', 'hardlink') and _supports(mode, input_path, output_dir, dry_run):
+            return mode
+        if mode == 'symlink':
+            break
+    return 'symlink'
+
+
+def reconcile_keys(desired, key_path, stats, dry_run=False):
+    # Only symlinks are managed, real key files placed by the user are left alone
+    for entry in _scandir(key_path):
+        if entry.is_symlink() and entry.name not in desired:
+            _remove(entry, stats, dry_run)
+
+    for key_link, key in desired.items():
+        out_path = os.path.join(key_path, key_link)
+        if os.path.exists(out_path) and not os.path.islink(out_path):
+            _log('WARN: Duplicate key: {}'.format(key_link), e=True)
+        else:
+            _sync_link(key, out_path, stats, dry_run)
+
+
+def sync_tree(input_path, output_path, stats, preserve=(), dry_run=False, mode='symlink'):
+    # Create symbolic links to keep files lowercase without renaming,
+    # touching only the entries that differ from what is on disk
+    if mode == 'dir':
+        _sync_link(input_path, output_path, stats, dry_run)
+        return
+    sync_file = {'symlink': _sync_link, 'hardlink': _sync_hardlink, 'reflink': _sync_reflink}[mode]
+
+    if os.path.islink(output_path) or (os.path.lexists(output_path) and not os.path.isdir(output_path)):
+        if not dry_run:
+            os.unlink(output_path)
+        stats['removed'] += 1
+    exists = os.path.isdir(output_path) and not os.path.islink(output_path)
+    if not exists:
+        if not dry_run:
+            os.mkdir(output_path)
+        stats['created'] += 1
+
+    desired = {}
+    for entry in get_manifest(input_path):
+        desired[entry.link_path] = entry
+
+    if exists or not dry_run:
+        _prune(output_path, '', desired, stats, preserve, dry_run)
+
+    for entry in desired.values():
+        out_path = os.path.join(output_path, entry.link_path)
+        if entry.is_dir:
+            if not os.path.isdir(out_path) or (dry_run and not exists):
+                if not dry_run:
+                    os.mkdir(out_path)
+                stats['created'] += 1
+        elif dry_run and not exists:
+            stats['created'] += 1
+        else:
+            sync_file(os.path.join(input_path, entry.path), out_path, stats, dry_run)
+
+
+def _supports(mode, input_path, output_dir, dry_run=False):
+    # Hard links and clones only work within one filesystem, and not every filesystem
+    # supports them, so they are tried once for every pair of devices
+    key = (mode, os.stat(input_path).st_dev, os.stat(_existing_parent(output_dir)).st_dev)
+    if key in _SUPPORTED:
+        return _SUPPORTED[key]
+    if key[1] != key[2]:
+        return _SUPPORTED.setdefault(key, False)
+    # Dry runs do not write the probe file and only check the devices
+    source = next((os.path.join(input_path, entry.path) for entry in get_manifest(input_path) if not entry.is_dir),
+                  None)
+    if dry_run or source is None or not os.path.isdir(output_dir):
+        return True
+
+    probe = os.path.join(output_dir, '.a3update-{}-probe-{}'.format(mode, os.getpid()))
+    try:
+        if mode == 'hardlink':
+            os.link(source, probe)
+        else:
+            _reflink(source, probe)
+        supported = True
+    except (OSError, ImportError):
+        supported = False
+    if os.path.lexists(probe):
+        os.unlink(probe)
+    return _SUPPORTED.setdefault(key, supported)
+
+
+def _existing_parent(path):
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def _scandir(path):
+    # A target that was never linked to is empty, which only happens during dry runs
+    return os.scandir(path) if os.path.isdir(path) else ()
+
+
+def _prune(output_path, link_path, desired, stats, preserve, dry_run=False):
+    # Remove everything that is not part of the manifest, or has the wrong type
+    with os.scandir(os.path.join(output_path, link_path)) as it:
+        for entry in it:
+            entry_link_path = os.path.join(link_path, entry.name)
+            wanted = desired.get(entry_link_path)
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if wanted is None and not is_dir and entry.is_file(follow_symlinks=False) \
+                    and any(fnmatch.fnmatch(entry.name, p) for p in preserve):
+                continue
+            if wanted is None or wanted.is_dir != is_dir:
+                _remove(entry, stats, dry_run)
+            elif is_dir:
+                _prune(output_path, entry_link_path, desired, stats, preserve, dry_run)
+
+
+def _sync_link(target, link_path, stats, dry_run=False):
+    if os.path.islink(link_path) and os.readlink(link_path) == target:
+        return
+    _replace(link_path, stats, dry_run)
+    if not dry_run:
+        os.symlink(target, link_path)
+
+
+def _sync_hardlink(target, link_path, stats, dry_run=False):
+    # SteamCMD replaces updated files, which leaves the old inode behind in the target
+    try:
+        st = os.lstat(link_path)
+        if stat.S_ISREG(st.st_mode) and os.path.samestat(st, os.stat(target)):
+            return
+    except FileNotFoundError:
+        pass
+    _replace(link_path, stats, dry_run)
+    if not dry_run:
+        os.link(target, link_path)
+
+
+def _sync_reflink(target, path, stats, dry_run=False):
+    # Clones keep the size and mtime of their source, so they are compared like the file index does
+    try:
+        st = os.lstat(path)
+        source = os.stat(target)
+        if stat.S_ISREG(st.st_mode) and not os.path.samestat(st, source) \
+                and (st.st_size, st.st_mtime_ns) == (source.st_size, source.st_mtime_ns):
+            return
+    except FileNotFoundError:
+        pass
+    _replace(path, stats, dry_run)
+    if not dry_run:
+        _reflink(target, path)
+
+
+def _reflink(source, path):
+    import fcntl
+    try:
+        with open(source, 'rb') as src, open(path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+    except OSError:
+        if os.path.lexists(path):
+            os.unlink(path)
+        raise
+    shutil.copystat(source, path)
+
+
+def _replace(path, stats, dry_run=False):
+    # Counts the new entry at path and removes whatever is in its way
+    if os.path.isdir(path) and not os.path.islink(path):
+        stats['retargeted'] += 1
+        if not dry_run:
+            shutil.rmtree(path)
+    elif os.path.lexists(path):
+        stats['retargeted'] += 1
+        if not dry_run:
+            os.unlink(path)
+    else:
+        stats['created'] += 1
+
+
+def _remove(entry, stats, dry_run=False):
+    if not dry_run:
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.unlink(entry.path)
+    stats['removed'] += 1
@@ -0,0 +1,114 @@
+import os
+import shutil
+
+# A staged target keeps two generations of its mod folders in stage_dir. stage_dir/current
+# points at the live one and the public directory only holds links through current,
+# so a new generation is built next to the live one and published by a single rename.
+GENERATIONS = ('a', 'b')
+CURRENT = 'current'
+
+
+def stage_dir(config_yaml, name):
+    # Returns the staging directory of a target, or None when staging is disabled
+    staging_config = config_yaml.get('staging', {})
+    if not staging_config.get('active', True):
+        return None
+    return os.path.join(staging_config.get('directory') or os.path.join(config_yaml['mod_dir'], 'staging'), name)
+
+
+def current_path(stage):
+    # The live generation, None before the first publish
+    link = os.path.join(stage, CURRENT)
+    return os.path.join(stage, os.readlink(link)) if os.path.islink(link) else None
+
+
+def build_path(stage, create=True):
+    # The generation that is not live, it still holds the generation before the
+    # previous one so only what changed since then has to be relinked
+    current = current_path(stage)
+    generation = GENERATIONS[1] if current and os.path.basename(current) == GENERATIONS[0] else GENERATIONS[0]
+    path = os.path.join(stage, generation)
+    if create and not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def flip(stage, path):
+    # Point current at path, os.replace swaps the link atomically
+    temp_link = os.path.join(stage, CURRENT + '.tmp')
+    if os.path.lexists(temp_link):
+        os.unlink(temp_link)
+    os.symlink(os.path.basename(path), temp_link)
+    os.replace(temp_link, os.path.join(stage, CURRENT))
+
+
+def rollback(stage):
+    # Make the previous generation live again, returns False if there is none
+    current = current_path(stage)
+    previous = build_path(stage, create=False)
+    if current is None or not os.path.isdir(previous):
+        return False
+    flip(stage, previous)
+    return True
+
+
+def publish_links(stage, public_path, stats, folder_names=None, dry_run=False):
+    # Link every entry of the live generation into public_path through current, folder_names
+    # replaces its mod folders with the given ones. Links to entries that are gone
+    # and leftover @ folders from before staging are removed
+    current = current_path(stage)
+    wanted = set(os.listdir(current)) if current else set()
+    if folder_names is not None:
+        wanted = {name for name in wanted if not name.startswith('@')} | set(folder_names)
+    for entry in os.scandir(public_path):
+        if entry.name in wanted:
+            continue
+        if is_published(stage, entry.path) or entry.name.startswith('@'):
+            if not dry_run:
+                _remove(entry.path)
+            stats['removed'] += 1
+
+    for name in wanted:
+        link_path = os.path.join(public_path, name)
+        target = os.path.join(stage, CURRENT, name)
+        if os.path.islink(link_path) and os.readlink(link_path) == target:
+            continue
+        if os.path.lexists(link_path):
+            stats['retargeted'] += 1
+        else:
+            stats['created'] += 1
+        if dry_run:
+            continue
+        # Real folders cannot be replaced by a rename, they only exist once when migrating to staging
+        if os.path.isdir(link_path) and not os.path.islink(link_path):
+            shutil.rmtree(link_path)
+        temp_link = link_path + '.tmp'
+        if os.path.lexists(temp_link):
+            os.unlink(temp_link)
+        os.symlink(target, temp_link)
+        os.replace(temp_link, link_path)
+
+
+def publish_dir(stage, public_path):
+    # For outputs that are owned entirely by a3update, public_path itself links to the live generation
+    target = os.path.join(stage, CURRENT)
+    if os.path.islink(public_path) and os.readlink(public_path) == target:
+        return
+    if os.path.isdir(public_path) and not os.path.islink(public_path):
+        shutil.rmtree(public_path)
+    temp_link = public_path + '.tmp'
+    if os.path.lexists(temp_link):
+        os.unlink(temp_link)
+    os.symlink(target, temp_link)
+    os.replace(temp_link, public_path)
+
+
+def is_published(stage, path):
+    return os.path.islink(path) and os.readlink(path) == os.path.join(stage, CURRENT, os.path.basename(path))
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+
+DEFAULT_BASE_URL = 'https://api.steampowered.com'
+
+# Methods taking a list of publishedfileids, mapped to the parameter holding its length
+# and the response field holding the per item results
+CHUNKED_METHODS = {
+    'ISteamRemoteStorage.GetCollectionDetails': ('collectioncount', 'collectiondetails'),
+    'ISteamRemoteStorage.GetPublishedFileDetails': ('itemcount', 'publishedfiledetails'),
+}
+
+
+class RateLimitError(Exception):
+    def __init__(self, retry_after=None):
+        super().__init__('Steam Web API rate limit exceeded')
+        self.retry_after = retry_after
+
+
+# Client for the ISteamRemoteStorage methods a3update uses. Unlike steam.webapi.WebAPI
+# it does not fetch the interface list on startup, keeps its connections alive and
+# splits long id lists into chunks that are requested concurrently.
+# Any base_url serving the same paths can be used, e.g. a local stand-in.
+class SteamWebAPI:
+    def __init__(self, key=None, base_url=DEFAULT_BASE_URL, chunk_size=100, concurrency=8, timeout=30):
+        self.key = key
+        self.base_url = base_url.rstrip('/')
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        # requests is only imported once a response is not served from the cache
+        with self._session_lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                self._session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+        return self._session
+
+    def call(self, method_path, **params):
+        if method_path not in CHUNKED_METHODS:
+            return self._post(method_path, params)
+
+        count_param, results_field = CHUNKED_METHODS[method_path]
+        ids = list(params.pop('publishedfileids'))
+        params.pop(count_param, None)
+        chunks = [ids[i:i + self.chunk_size] for i in range(0, len(ids), self.chunk_size)] or [[]]
+        responses = asyncio.run(self._post_chunks(method_path, params, count_param, chunks))
+
+        # Merge the chunks back into the response a single request would have returned
+        merged = {'result': 1, 'resultcount': 0, results_field: []}
+        for response in responses:
+            response = response.get('response', {})
+            merged['result'] = response.get('result', merged['result'])
+            merged['resultcount'] += response.get('resultcount', 0)
+            merged[results_field] += response.get(results_field, [])
+        return {'response': merged}
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+    async def _post_chunks(self, method_path, params, count_param, chunks):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def post(chunk):
+            chunk_params = dict(params, **{count_param: len(chunk), 'publishedfileids': chunk})
+            async with semaphore:
+                return await loop.run_in_executor(None, self._post, method_path, chunk_params)
+
+        return await asyncio.gather(*(post(chunk) for chunk in chunks))
+
+    def _post(self, method_path, params):
+        interface, method = method_path.split('.')
+        data = {}
+        for name, value in params.items():
+            if isinstance(value, (list, tuple)):
+                # Lists are sent as name[0]=..&name[1]=..
+                for i, item in enumerate(value):
+                    data['{}[{}]'.format(name, i)] = item
+            else:
+                data[name] = value
+        if self.key:
+            data['key'] = self.key
+
+        response = self.session.post('{}/{}/{}/v1/'.format(self.base_url, interface, method),
+                                     data=data, timeout=self.timeout)
+        if response.status_code == 429:
+            retry_after = response.headers.get('Retry-After')
+            raise RateLimitError(int(retry_after) if retry_after and retry_after.isdigit() else None)
+        response.raise_for_status()
+        return response.json()
@@ -4,7 +4,8 @@ import sys
 import click
 import subprocess
 import shutil
-from a3update.a3update import _create_mod_link, _filename, _log
+from a3update.a3update import _log
+from a3update import metrics, staging, swifty_repo
 
 
 def _setup(config):
@@ -24,6 +25,9 @@ def _setup(config):
             'path_to_json': path_to_json,
             'output_path': click.prompt('Enter output path for repo',
                                         type=click.Path(exists=True, resolve_path=True, file_okay=False)),
+            # Not yet checked against swifty-cli output, so swifty-cli stays the default
+            'native': click.confirm('Build the repo natively instead of through swifty-cli (experimental)',
+                                    default=False, show_default=True),
         }
 
         swifty_dir = os.path.join(config['mod_dir'], 'swifty')
@@ -66,48 +70,73 @@ def _setup(config):
             'path_to_cli': None,
             'path_to_json': None,
             'output_path': None,
+            'native': False,
         }
 
 
-def update(mods, config_yaml):
+def link_target(config_yaml):
+    if config_yaml['swifty'].get('native', False):
+        # The native builder links straight into the repo, next to the generated mod.srf files
+        return {
+            'path': config_yaml['swifty']['output_path'],
+            'preserve': (swifty_repo.SRF_NAME,),
+            'stage': staging.stage_dir(config_yaml, 'swifty'),
+        }
 
     repo_config = json.load(click.open_file(config_yaml['swifty']['path_to_json']))
+    return {'path': repo_config['basePath'], 'stage': staging.stage_dir(config_yaml, 'swifty')}
+
 
-    # Wipe current repo, to be recreated below
-    for filename in os.listdir(repo_config['basePath']):
-        if filename.startswith('@'):
-            shutil.rmtree(os.path.join(repo_config['basePath'], filename))
+def plan(config_yaml, link_plan):
+    # Report what update() would do, without building anything
+    if not config_yaml['swifty'].get('native', False):
+        click.echo('Swifty repo: full rebuild')
+        return
+    outdated, _, _ = swifty_repo.compare(link_plan, config_yaml['swifty']['output_path'],
+                                         _state_path(config_yaml))
+    click.echo('Swifty repo: {} of {} mods to rehash'.format(len(outdated), len(link_plan['mods'])))
+    for folder_name, _ in outdated:
+        click.echo('  {}'.format(folder_name))
 
-    # for filename in os.listdir(os.path.join(repo_config['basePath'], 'optional')):
-    #    if filename.startswith('@'):
-    #        shutil.rmtree(os.path.join(config_yaml['a3sync']['directory'], filename))
 
-    for filename in os.listdir(config_yaml['swifty']['output_path']):
-        f = os.path.join(config_yaml['swifty']['output_path'], filename)
+def update(mods, config_yaml, link_plan=None, output_path=None):
+    # output_path is where the native build writes to, the staged generation
+    # of the repo if staging is enabled. Returns False if swifty-cli failed
+    if config_yaml['swifty'].get('native', False) and link_plan is not None:
+        repo_config = json.load(click.open_file(config_yaml['swifty']['path_to_json']))
+        rebuilt = swifty_repo.build(link_plan, repo_config, output_path or config_yaml['swifty']['output_path'],
+                                    _state_path(config_yaml),
+                                    public_path=config_yaml['swifty']['output_path'])
+        click.echo('Rebuilt Swifty mods: {}'.format(rebuilt))
+        metrics.set_value('items', rebuilt, kind='swifty_mods_rebuilt')
+        return True
+
+    # swifty-cli writes the whole repo, so it builds into the next generation when staging
+    stage = staging.stage_dir(config_yaml, 'swifty-output')
+    output_path = staging.build_path(stage) if stage else config_yaml['swifty']['output_path']
+    for filename in os.listdir(output_path):
+        f = os.path.join(output_path, filename)
         if os.path.isfile(f):
             os.remove(f)
         else:
             shutil.rmtree(f)
 
-    # Create symlinks to all mods used
-    for mod in mods:
-        _create_mod_link(
-            os.path.join(config_yaml['mod_dir_full'], mod['published_file_id']),
-            os.path.join(repo_config['basePath'], mod['folder_name'])
-        )
-    # Handle external addons
-    external_addon_dir = config_yaml['external_addon_dir']
-    if os.path.isdir(external_addon_dir):
-        for filename in os.listdir(external_addon_dir):
-            out_path = os.path.join(repo_config['basePath'], _filename(filename))
-            if not os.path.exists(out_path):
-                _create_mod_link(os.path.join(external_addon_dir, filename), out_path)
-            else:
-                _log('ERR: Conflicting external addon "{}"'.format(filename), e=True)
-
     if sys.platform == 'linux' or sys.platform == 'linux2':
-        subprocess.call(['mono', config_yaml['swifty']['path_to_cli'], 'create',
-                         config_yaml['swifty']['path_to_json'], config_yaml['swifty']['output_path']])
+        returncode = subprocess.call(['mono', config_yaml['swifty']['path_to_cli'], 'create',
+                                      config_yaml['swifty']['path_to_json'], output_path])
     else:
-        subprocess.call([config_yaml['swifty']['path_to_cli'], 'create',
-                        config_yaml['swifty']['path_to_json'], config_yaml['swifty']['output_path']])
+        returncode = subprocess.call([config_yaml['swifty']['path_to_cli'], 'create',
+                                     config_yaml['swifty']['path_to_json'], output_path])
+
+    # A failed build is not published, the live generation stays as it is
+    if returncode != 0:
+        _log('ERR: swifty-cli exited with {}'.format(returncode), e=True)
+        return False
+    if stage:
+        staging.flip(stage, output_path)
+        staging.publish_dir(stage, config_yaml['swifty']['output_path'])
+    return True
+
+
+def _state_path(config_yaml):
+    return config_yaml['swifty'].get('state_path') or os.path.join(config_yaml['mod_dir'], 'swifty-state.json')
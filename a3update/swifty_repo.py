@@ -0,0 +1,182 @@
+import fnmatch
+import hashlib
+import mmap
+import os
+import struct
+import click
+from a3update.files import load_json, save_json
+from a3update.manifest import get_manifest
+from a3update.pool import process_pool
+
+SRF_NAME = 'mod.srf'
+PBO_PRODUCT_ENTRY = 0x56657273
+
+
+def build(link_plan, repo_config, output_path, state_path, workers=None, public_path=None):
+    # Incremental replacement for "swifty-cli create", mods whose files did not change
+    # since the last build keep their existing mod.srf. public_path is the live repo
+    # when building into a staged output_path
+    public_path = public_path or output_path
+    outdated, srfs, new_state = compare(link_plan, public_path, state_path)
+    if public_path != output_path:
+        for folder_name in srfs:
+            _link_srf(os.path.join(public_path, folder_name, SRF_NAME),
+                      os.path.join(output_path, folder_name, SRF_NAME))
+
+    click.echo('Hashing Swifty mods: {} of {}'.format(len(outdated), len(link_plan['mods'])))
+    files = [(folder_name, input_path, entry) for folder_name, input_path in outdated
+             for entry in get_manifest(input_path) if not entry.is_dir]
+    with process_pool(workers) as executor:
+        hashed = executor.map(_hash_file, [os.path.join(input_path, entry.path) for _, input_path, entry in files],
+                              chunksize=8)
+        mod_files = {folder_name: [] for folder_name, _ in outdated}
+        for (folder_name, input_path, entry), file_details in zip(files, hashed):
+            file_details['Path'] = '/'.join([folder_name] + entry.link_path.split(os.sep))
+            mod_files[folder_name].append(file_details)
+
+    for folder_name, files in mod_files.items():
+        files.sort(key=lambda f: f['Path'])
+        srf = {
+            'Name': folder_name,
+            'Checksum': _checksum(f['Checksum'] for f in files),
+            'Files': files,
+        }
+        save_json(os.path.join(output_path, folder_name, SRF_NAME), srf)
+        srfs[folder_name] = srf
+
+    repo = _repo(repo_config, public_path, srfs)
+    save_json(os.path.join(output_path, 'repo.json'), repo)
+    save_json(state_path, new_state)
+    return len(outdated)
+
+
+def compare(link_plan, output_path, state_path):
+    # Returns the (folder_name, input_path) of mods that need hashing, the reusable
+    # mod.srf contents by folder name and the state to store after building
+    state = load_json(state_path, {})
+    new_state = {}
+    srfs = {}
+    outdated = []
+    for folder_name, input_path in link_plan['mods'].items():
+        srf_path = os.path.join(output_path, folder_name, SRF_NAME)
+        fingerprint = _fingerprint(input_path)
+        new_state[folder_name] = fingerprint
+        srf = load_json(srf_path) if state.get(folder_name) == fingerprint else None
+        if srf is None:
+            outdated.append((folder_name, input_path))
+        else:
+            srfs[folder_name] = srf
+    return outdated, srfs, new_state
+
+
+def _repo(repo_config, output_path, srfs):
+    required_mods = []
+    optional_mods = []
+    for folder_name in sorted(srfs):
+        mod = {'modName': folder_name, 'checkSum': srfs[folder_name]['Checksum']}
+        for pattern in repo_config.get('requiredMods', []):
+            if fnmatch.fnmatch(folder_name, pattern['modName']):
+                required_mods.append(dict(mod, enabled=pattern.get('enabled', True)))
+                break
+        else:
+            for pattern in repo_config.get('optionalMods', []):
+                if fnmatch.fnmatch(folder_name, pattern['modName']):
+                    optional_mods.append(dict(mod, enabled=pattern.get('enabled', False)))
+                    break
+
+    repo = {key: value for key, value in repo_config.items()
+            if key not in ('basePath', 'requiredMods', 'optionalMods')}
+    repo['requiredMods'] = required_mods
+    repo['optionalMods'] = optional_mods
+    repo['checksum'] = _checksum(mod['checkSum'] for mod in required_mods + optional_mods)
+    for image in ('iconImage', 'repoImage'):
+        path = os.path.join(output_path, repo_config.get(image + 'Path') or '')
+        repo[image + 'Checksum'] = _hash_file(path)['Checksum'] if os.path.isfile(path) else None
+    return repo
+
+
+def _link_srf(source, path):
+    # Unchanged mods share their mod.srf between generations
+    if os.path.exists(path) and os.path.samefile(source, path):
+        return
+    temp_path = path + '.tmp'
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    os.link(source, temp_path)
+    os.replace(temp_path, path)
+
+
+def _fingerprint(input_path):
+    sha1 = hashlib.sha1()
+    for entry in get_manifest(input_path):
+        sha1.update('{}\0{}\0{}\0{}\n'.format(entry.link_path, entry.is_dir, entry.size, entry.mtime).encode())
+    return sha1.hexdigest()
+
+
+def _hash_file(path):
+    # PBOs are split into their header, every packed file and the trailing signature,
+    # so clients only fetch the parts of a PBO that changed
+    with open(path, 'rb') as f:
+        length = os.fstat(f.fileno()).st_size
+        if not length:
+            return {'Length': 0, 'Checksum': hashlib.md5().hexdigest().upper(), 'Parts': []}
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            parts = _pbo_parts(data) if path.lower().endswith('.pbo') else None
+            if parts is None:
+                parts = [(os.path.basename(path), 0, length)]
+
+            file_hash = hashlib.md5(data).hexdigest().upper()
+            return {
+                'Length': length,
+                'Checksum': file_hash,
+                'Parts': [{
+                    'Path': name,
+                    'Start': start,
+                    'Length': part_length,
+                    'Checksum': hashlib.md5(data[start:start + part_length]).hexdigest().upper(),
+                } for name, start, part_length in parts],
+            }
+
+
+def _pbo_parts(data):
+    offset = 0
+    entries = []
+    try:
+        while True:
+            name_end = data.find(b'\0', offset)
+            if name_end < 0:
+                return None
+            name = data[offset:name_end]
+            method, _, _, _, size = struct.unpack_from('<5I', data, name_end + 1)
+            offset = name_end + 21
+
+            if not name and method == PBO_PRODUCT_ENTRY:
+                # Header extension, key value pairs terminated by an empty string
+                while True:
+                    value_end = data.find(b'\0', offset)
+                    if value_end < 0:
+                        return None
+                    value = data[offset:value_end]
+                    offset = value_end + 1
+                    if not value:
+                        break
+                continue
+            if not name:
+                break
+            entries.append((name.decode('utf-8', 'replace'), size))
+    except struct.error:
+        return None
+
+    parts = [('$$HEADER$$', 0, offset)]
+    for name, size in entries:
+        if offset + size > len(data):
+            return None
+        parts.append((name, offset, size))
+        offset += size
+    parts.append(('$$END$$', offset, len(data) - offset))
+    return parts
+
+
+def _checksum(checksums):
+    return hashlib.md5(''.join(checksums).encode()).hexdigest().upper()
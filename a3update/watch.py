@@ -0,0 +1,69 @@
+import time
+import click
+from a3update.a3update import _log
+from a3update.steam_api import RateLimitError
+
+
+def diff(previous, current):
+    # previous and current map published file ids to their time_updated,
+    # returns the ids that were added, removed or updated in between
+    added = current.keys() - previous.keys()
+    removed = previous.keys() - current.keys()
+    updated = {i for i in current.keys() & previous.keys() if current[i] != previous[i]}
+    return added, removed, updated
+
+
+def run(poll, apply, interval=300, settle=60, max_backoff=3600, sleep=time.sleep, clock=time.monotonic):
+    # poll() returns the current mod array of the collections and apply(mods, changed) runs
+    # the update pipeline, changed being None for the initial full run.
+    # Changes are applied once a poll finds nothing new, or after waiting for more changes
+    # for longer than interval, so a burst of updates is handled by a single run
+    seen = None
+    pending = set()
+    pending_since = None
+    backoff = 0
+    while True:
+        try:
+            mods = poll()
+        except Exception as e:
+            backoff = min(max(backoff * 2, interval), max_backoff)
+            if isinstance(e, RateLimitError) and e.retry_after:
+                backoff = max(backoff, e.retry_after)
+            _log('WARN: Polling collections failed ({}), retrying in {}s'.format(e, backoff), e=True)
+            sleep(backoff)
+            continue
+        backoff = 0
+
+        current = {mod['published_file_id']: mod['time_updated'] for mod in mods}
+        if seen is None:
+            if _apply(apply, mods, None):
+                seen = current
+            sleep(interval)
+            continue
+
+        added, removed, updated = diff(seen, current)
+        if added or removed or updated:
+            click.echo('Detected {} added, {} removed and {} updated workshop items'.format(
+                len(added), len(removed), len(updated)))
+            pending |= added | removed | updated
+            pending_since = pending_since or clock()
+            seen = current
+            if clock() - pending_since < interval:
+                sleep(settle)
+                continue
+
+        if pending:
+            if _apply(apply, mods, pending):
+                pending = set()
+                pending_since = None
+        sleep(interval)
+
+
+def _apply(apply, mods, changed):
+    # A failed run is retried with the same changes after the next poll
+    try:
+        apply(mods, changed)
+        return True
+    except Exception as e:
+        _log('ERR: Update failed ({})'.format(e), e=True)
+        return False
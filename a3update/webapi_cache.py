@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+import time
+import click
+from a3update.a3update import _log
+from a3update.files import load_json, save_json
+
+
+# On-disk cache for Steam Web API responses, keyed by method and parameters.
+# Any object exposing call(method_path, **params) can be used as api.
+class WebAPICache:
+    def __init__(self, api, directory, ttl=3600, max_age=604800, offline=False, read_only=False):
+        self.api = api
+        self.directory = directory
+        self.ttl = ttl
+        self.max_age = max_age
+        self.offline = offline
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.last_error = None
+
+        if not os.path.isdir(self.directory) and not read_only:
+            os.makedirs(self.directory)
+
+    def call(self, method_path, **params):
+        path = os.path.join(self.directory, self._key(method_path, params) + '.json')
+        entry = load_json(path)
+
+        if entry is not None and (self.offline or time.time() - entry['time'] < self.ttl):
+            self.hits += 1
+            return entry['response']
+
+        if self.offline:
+            _log('WARN: No cached response for {} while offline'.format(method_path), e=True)
+            return {}
+
+        self.misses += 1
+        try:
+            response = self.api.call(method_path, **params)
+        except Exception as e:
+            self.last_error = e
+            if entry is None:
+                raise
+            _log('WARN: Querying {} failed ({}), using cached response'.format(method_path, e), e=True)
+            return entry['response']
+
+        if not self.read_only:
+            save_json(path, {'time': time.time(), 'method': method_path, 'response': response})
+        return response
+
+    def evict(self):
+        evicted = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json') and time.time() - entry.stat().st_mtime > self.max_age:
+                os.remove(entry.path)
+                evicted += 1
+        if evicted:
+            click.echo('Evicted {} cached Web API responses'.format(evicted))
+        return evicted
+
+    @staticmethod
+    def _key(method_path, params):
+        return hashlib.sha1(json.dumps([method_path, params], sort_keys=True, default=str).encode()).hexdigest()
@@ -0,0 +1,82 @@
+import os
+import vdf
+from a3update.a3update import ARMA_APPID
+from a3update.files import atomic_write
+
+
+def acf_path(mod_dir):
+    return os.path.join(mod_dir, 'steamapps', 'workshop', 'appworkshop_{}.acf'.format(ARMA_APPID))
+
+
+def load_acf(mod_dir):
+    path = acf_path(mod_dir)
+    if not os.path.isfile(path):
+        return {'AppWorkshop': {}}
+    with open(path, 'r', encoding='utf-8') as f:
+        return vdf.load(f)
+
+
+def installed_items(mod_dir, mod_dir_full):
+    # Update state of every workshop item SteamCMD reports as installed,
+    # items whose folder has gone missing are left out
+    installed = load_acf(mod_dir).get('AppWorkshop', {}).get('WorkshopItemsInstalled', {})
+    index = {}
+    for published_file_id, item in installed.items():
+        if os.path.isdir(os.path.join(mod_dir_full, published_file_id)):
+            index[published_file_id] = {
+                'time_updated': int(item.get('timeupdated', 0)),
+                'size': int(item.get('size', 0)),
+            }
+    return index
+
+
+def outdated_mods(mods, index):
+    outdated = []
+    for mod in mods:
+        installed = index.get(mod['published_file_id'])
+        if installed is None \
+                or mod['time_updated'] > installed['time_updated'] \
+                or (mod['file_size'] and mod['file_size'] != installed['size']):
+            outdated.append(mod)
+    return outdated
+
+
+def content_dir(mod_dir):
+    return os.path.join(mod_dir, 'steamapps', 'workshop', 'content', str(ARMA_APPID))
+
+
+def save_acf(mod_dir, acf):
+    path = acf_path(mod_dir)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with atomic_write(path, encoding='utf-8') as f:
+        vdf.dump(acf, f, pretty=True)
+
+
+def copy_acf_items(source_acf, target_acf, published_file_ids):
+    source = source_acf.get('AppWorkshop', {})
+    target = target_acf.setdefault('AppWorkshop', {})
+    for section in ('WorkshopItemsInstalled', 'WorkshopItemDetails'):
+        for published_file_id in published_file_ids:
+            if published_file_id in source.get(section, {}):
+                target.setdefault(section, {})[published_file_id] = source[section][published_file_id]
+    return target_acf
+
+
+def installed_ids(mod_dir):
+    # Every item SteamCMD knows of, whether it is in the acf, on disk or both
+    ids = set(load_acf(mod_dir).get('AppWorkshop', {}).get('WorkshopItemsInstalled', {}))
+    if os.path.isdir(content_dir(mod_dir)):
+        ids.update(name for name in os.listdir(content_dir(mod_dir)) if name.isdigit())
+    return ids
+
+
+def remove_acf_items(acf, published_file_ids):
+    workshop = acf.setdefault('AppWorkshop', {})
+    for section in ('WorkshopItemsInstalled', 'WorkshopItemDetails'):
+        for published_file_id in published_file_ids:
+            workshop.get(section, {}).pop(published_file_id, None)
+    if 'SizeOnDisk' in workshop:
+        workshop['SizeOnDisk'] = str(sum(int(item.get('size', 0))
+                                         for item in workshop.get('WorkshopItemsInstalled', {}).values()))
+    return acf
@@ -0,0 +1,86 @@
+import os
+import shutil
+import time
+import click
+from a3update import metrics, workshop
+from a3update.a3update import _log
+from a3update.files import load_json, save_json
+from a3update.manifest import get_manifest
+
+
+def collect(mods, config_yaml, dry_run=False):
+    # Workshop items that are no longer part of any collection are reported with their size
+    # and deleted once they have been orphaned for longer than the grace period.
+    # Returns the bytes used by the collection's mods, by orphans and the bytes reclaimed
+    mod_dir = config_yaml['mod_dir']
+    gc_config = config_yaml.get('gc', {})
+    grace_period = gc_config.get('grace_period', 604800)
+    state_path = gc_config.get('state_path') or os.path.join(mod_dir, 'gc-state.json')
+
+    wanted = {mod['published_file_id'] for mod in mods}
+    orphans = sorted(workshop.installed_ids(mod_dir) - wanted)
+    state = load_json(state_path, {})
+    now = time.time()
+    # Only items that are still orphaned keep their timestamp
+    new_state = {published_file_id: state.get(published_file_id, now) for published_file_id in orphans}
+
+    # Mods in use were already scanned for linking, ignored files are not counted
+    used = 0
+    for published_file_id in wanted:
+        path = os.path.join(config_yaml['mod_dir_full'], published_file_id)
+        if os.path.isdir(path):
+            used += sum(entry.size for entry in get_manifest(path))
+    orphaned = 0
+    expired = []
+    for published_file_id in orphans:
+        size = _size(os.path.join(config_yaml['mod_dir_full'], published_file_id))
+        orphaned += size
+        age = now - new_state[published_file_id]
+        if age >= grace_period:
+            expired.append((published_file_id, size))
+            click.echo('Orphaned workshop item {}: {}, grace period expired'.format(
+                published_file_id, _human_size(size)))
+        else:
+            click.echo('Orphaned workshop item {}: {}, grace period ends in {:.1f} days'.format(
+                published_file_id, _human_size(size), (grace_period - age) / 86400))
+    click.echo('Workshop usage: {} by {} mods, {} by {} orphans'.format(
+        _human_size(used), len(wanted), _human_size(orphaned), len(orphans)))
+
+    reclaimed = sum(size for _, size in expired)
+    if not dry_run:
+        if expired:
+            # The acf is updated first, SteamCMD redownloads items whose folder is missing anyway
+            acf = workshop.load_acf(mod_dir)
+            workshop.save_acf(mod_dir, workshop.remove_acf_items(acf, [i for i, _ in expired]))
+            for published_file_id, _ in expired:
+                path = os.path.join(config_yaml['mod_dir_full'], published_file_id)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                del new_state[published_file_id]
+            _log('Reclaimed {} from {} orphaned workshop items'.format(_human_size(reclaimed), len(expired)))
+        save_json(state_path, new_state)
+
+    metrics.set_value('disk_bytes', used, kind='mods')
+    metrics.set_value('disk_bytes', orphaned, kind='orphans')
+    metrics.set_value('disk_bytes', reclaimed if not dry_run else 0, kind='reclaimed')
+    metrics.set_value('items', len(orphans), kind='orphans')
+    return used, orphaned, reclaimed
+
+
+def _size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _human_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} TiB'.format(size)
@@ -0,0 +1,85 @@
+import hashlib
+import math
+import mmap
+import os
+import time
+from itertools import accumulate
+from a3update.files import atomic_write
+from a3update.pool import process_pool
+
+ZSYNC_VERSION = '0.6.2'
+
+
+def generate_all(paths, workers=None):
+    # paths are the files that need a .zsync control file next to them
+    if not paths:
+        return 0
+    with process_pool(workers) as executor:
+        return sum(executor.map(generate, paths, chunksize=8))
+
+
+def needs_update(path):
+    zsync_path = path + '.zsync'
+    return not os.path.exists(zsync_path) or os.path.getmtime(zsync_path) < os.path.getmtime(path)
+
+
+def generate(path):
+    # Same output as zsyncmake, blocks are read through a memory map
+    from Cryptodome.Hash import MD4
+    stat = os.stat(path)
+    length = stat.st_size
+    blocksize = 2048 if length < 100000000 else 4096
+    seq_matches, rsum_len, checksum_len = _hash_lengths(length, blocksize)
+
+    sha1 = hashlib.sha1()
+    checksums = bytearray()
+    if length:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            sha1.update(data)
+            for offset in range(0, length, blocksize):
+                block = data[offset:offset + blocksize]
+                if len(block) < blocksize:
+                    block += bytes(blocksize - len(block))
+                checksums += _rsum(block)[4 - rsum_len:]
+                checksums += MD4.new(block).digest()[:checksum_len]
+
+    filename = os.path.basename(path)
+    header = (
+        'zsync: {}\n'
+        'Filename: {}\n'
+        'MTime: {}\n'
+        'Blocksize: {}\n'
+        'Length: {}\n'
+        'Hash-Lengths: {},{},{}\n'
+        'URL: {}\n'
+        'SHA-1: {}\n'
+        '\n'
+    ).format(ZSYNC_VERSION, filename, time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(stat.st_mtime)),
+             blocksize, length, seq_matches, rsum_len, checksum_len, filename, sha1.hexdigest())
+
+    with atomic_write(path + '.zsync', 'wb') as f:
+        f.write(header.encode('utf-8'))
+        f.write(checksums)
+    return 1
+
+
+def _rsum(block):
+    a = sum(block) & 0xffff
+    b = sum(accumulate(block)) & 0xffff
+    return a.to_bytes(2, 'big') + b.to_bytes(2, 'big')
+
+
+def _hash_lengths(length, blocksize):
+    # Mirrors the heuristics zsyncmake uses to pick the checksum lengths
+    seq_matches = 2 if length > blocksize else 1
+    length = max(length, 1)
+    blocks = length // blocksize
+
+    rsum_len = math.ceil(((math.log(length) + math.log(blocksize)) / math.log(2) - 8.6) / seq_matches / 8)
+    rsum_len = min(max(rsum_len, 2), 4)
+
+    checksum_len = math.ceil((20 + (math.log(length) + math.log(1 + blocks)) / math.log(2)) / seq_matches / 8)
+    checksum_len = max(checksum_len, int((7.9 + (20 + math.log(1 + blocks) / math.log(2))) / 8))
+    checksum_len = min(checksum_len, 16)
+
+    return seq_matches, rsum_len, checksum_len
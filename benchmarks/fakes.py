@@ -0,0 +1,104 @@
+import json
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+from pysteamcmdwrapper import SteamCMDException
+from a3update import workshop
+
+
+# Stand-in for pysteamcmdwrapper.SteamCMD, "downloads" items by touching their
+# folder and manifest entry the way SteamCMD does
+class FakeSteamCMD:
+    def __init__(self, installation_path, published_files=None):
+        self.installation_path = installation_path
+        self.published_files = published_files or {}
+        self.commands = []
+
+    def install(self, force=False):
+        raise SteamCMDException('Steamcmd is already installed.')
+
+    def login(self, uname=None, passw=None):
+        return 0
+
+    def app_update(self, app_id, install_dir=None, validate=None, beta=None, betapassword=None):
+        self.commands.append('+app_update {}'.format(app_id))
+        return 0
+
+    def run(self, command):
+        cmd = command.get_cmd()
+        self.commands.append(cmd)
+        install_dir = re.search(r'\+force_install_dir "([^"]*)"', cmd).group(1)
+        acf = workshop.load_acf(install_dir)
+        installed = acf.setdefault('AppWorkshop', {}).setdefault('WorkshopItemsInstalled', {})
+
+        output = []
+        for published_file_id in re.findall(r'\+workshop_download_item \d+ (\d+)', cmd):
+            path = os.path.join(workshop.content_dir(install_dir), published_file_id)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            details = self.published_files.get(published_file_id, {})
+            installed[published_file_id] = {
+                'size': str(details.get('file_size', 0)),
+                'timeupdated': str(details.get('time_updated', 0)),
+                'manifest': '0',
+            }
+            output.append('Success. Downloaded item {} to "{}" (0 bytes)'.format(published_file_id, path))
+        workshop.save_acf(install_dir, acf)
+        return '\n'.join(output)
+
+
+# Stand-in for steam.webapi.WebAPI serving a single collection of published_files
+class FakeWebAPI:
+    def __init__(self, collection_id, published_files, title='Collection'):
+        self.collection_id = str(collection_id)
+        self.published_files = published_files
+        self.title = title
+        self.calls = 0
+
+    def call(self, method_path, **params):
+        self.calls += 1
+        ids = [str(i) for i in params['publishedfileids']]
+        if method_path == 'ISteamRemoteStorage.GetCollectionDetails':
+            return {'response': {'resultcount': len(ids), 'collectiondetails': [{
+                'publishedfileid': i,
+                'result': 1,
+                'children': [{'publishedfileid': child, 'sortorder': n, 'filetype': 0}
+                             for n, child in enumerate(self.published_files)] if i == self.collection_id else [],
+            } for i in ids]}}
+        if method_path == 'ISteamRemoteStorage.GetPublishedFileDetails':
+            details = []
+            for i in ids:
+                if i == self.collection_id:
+                    details.append({'publishedfileid': i, 'result': 1, 'title': self.title})
+                else:
+                    details.append(dict({'publishedfileid': i, 'result': 1}, **self.published_files.get(i, {})))
+            return {'response': {'resultcount': len(ids), 'publishedfiledetails': details}}
+        raise ValueError('Unsupported method {}'.format(method_path))
+
+
+# Local HTTP stand-in for api.steampowered.com, answering with web_api.call()
+def serve_web_api(web_api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            interface, method = self.path.strip('/').split('/')[:2]
+            form = dict(parse_qsl(self.rfile.read(int(self.headers['Content-Length'])).decode()))
+            params = {name: value for name, value in form.items() if '[' not in name}
+            params['publishedfileids'] = [value for name, value in sorted(
+                form.items(), key=lambda i: int(i[0][i[0].find('[') + 1:-1]) if '[' in i[0] else -1) if '[' in name]
+            body = json.dumps(web_api.call('{}.{}'.format(interface, method), **params)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
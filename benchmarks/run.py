@@ -0,0 +1,203 @@
+import importlib
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import click
+import pysteamcmdwrapper
+import yaml
+from click.testing import CliRunner
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from a3update import arma3sync, download, html_preset, manifest, reconcile  # noqa: E402
+from benchmarks.fakes import FakeSteamCMD, FakeWebAPI, serve_web_api  # noqa: E402
+
+a3update = importlib.import_module('a3update.a3update')
+
+SCALES = {
+    'small': (10, 50),
+    'medium': (100, 500),
+    'large': (1000, 500),
+}
+COLLECTION_ID = 1
+
+
+def generate_workshop(mod_dir_full, mods, files_per_mod, seed=0):
+    # Synthetic workshop tree, mixed case names, nested addons and a bikey for most mods
+    rnd = random.Random(seed)
+    published_files = {}
+    for i in range(mods):
+        published_file_id = str(450000000 + i)
+        path = os.path.join(mod_dir_full, published_file_id)
+        os.makedirs(os.path.join(path, 'Addons'))
+        os.makedirs(os.path.join(path, 'Keys'))
+        with open(os.path.join(path, 'mod.cpp'), 'w') as f:
+            f.write('name = "Mod {}";\n'.format(i))
+        if i % 10:
+            with open(os.path.join(path, 'Keys', 'Mod_{}.bikey'.format(i)), 'wb') as f:
+                f.write(rnd.randbytes(160))
+        for n in range(files_per_mod - 1):
+            sub_dir = os.path.join(path, 'Addons', 'Part {}'.format(n // 100)) if n >= 100 \
+                else os.path.join(path, 'Addons')
+            if not os.path.isdir(sub_dir):
+                os.makedirs(sub_dir)
+            with open(os.path.join(sub_dir, 'Mod{}_File{}.pbo'.format(i, n)), 'wb') as f:
+                f.write(rnd.randbytes(rnd.randint(16, 4096)))
+
+        published_files[published_file_id] = {
+            'title': 'Mod {}'.format(i),
+            'time_updated': 1600000000 + i,
+            'file_size': files_per_mod * 2048,
+        }
+    return published_files
+
+
+def make_config(root):
+    config = {
+        'arma_appid': 107410,
+        'server_appid': 233780,
+        'steamcmd_dir': os.path.join(root, 'steamcmd'),
+        'install_dir': os.path.join(root, 'server'),
+        'mod_dir': os.path.join(root, 'mods'),
+        'external_addon_dir': os.path.join(root, 'mods', 'external'),
+        'beta': '',
+        'collections': [COLLECTION_ID],
+        'handle_keys': True,
+        'api_key': 'benchmark',
+        'files_folders_to_ignore': [],
+        'webapi_cache': {'directory': os.path.join(root, 'webapi-cache'), 'ttl': 0, 'max_age': 604800},
+        'steamcmd_workers': 1,
+        'metrics': {'json_path': os.path.join(root, 'metrics.json'),
+                    'prometheus_path': os.path.join(root, 'a3update.prom')},
+        'a3sync': {'active': False, 'path_to_jar': None, 'repo_name': None,
+                   'directory': os.path.join(root, 'a3sync')},
+        'swifty': {'active': False, 'path_to_cli': None, 'path_to_json': None, 'output_path': None},
+        'html_preset': {'active': True, 'path_to_html': os.path.join(root, 'preset.html'), 'name': 'Benchmark'},
+    }
+    config['mod_dir_full'] = os.path.join(config['mod_dir'], 'steamapps', 'workshop', 'content', '107410')
+    for key in ('steamcmd_dir', 'external_addon_dir', 'mod_dir_full'):
+        os.makedirs(config[key])
+    os.makedirs(os.path.join(config['install_dir'], 'keys'))
+    os.makedirs(config['a3sync']['directory'])
+    return config
+
+
+def mod_array(published_files):
+    return [{
+        'name': details['title'],
+        'folder_name': '@{}'.format(a3update._filename(details['title'])),
+        'published_file_id': published_file_id,
+        'time_updated': details['time_updated'],
+        'file_size': details['file_size'],
+    } for published_file_id, details in published_files.items()]
+
+
+def timed(results, name, f, **info):
+    manifest.clear()
+    start = time.perf_counter()
+    f()
+    seconds = time.perf_counter() - start
+    results.append(dict(benchmark=name, seconds=round(seconds, 4), **info))
+    click.echo('{:<24} {:>10.3f}s'.format(name, seconds), err=True)
+
+
+def run_benchmarks(root, mods, files_per_mod):
+    config = make_config(root)
+    a3update.CONFIG_YAML = config
+    key_path = os.path.join(config['install_dir'], 'keys')
+    published_files = generate_workshop(config['mod_dir_full'], mods, files_per_mod)
+    mod_arr = mod_array(published_files)
+    info = {'mods': mods, 'files': mods * files_per_mod}
+    results = []
+    server = {'path': config['install_dir'], 'key_path': key_path}
+
+    timed(results, 'link_cold', lambda: reconcile.apply(reconcile.plan(mod_arr, config), [server]), **info)
+    timed(results, 'link_noop', lambda: reconcile.apply(reconcile.plan(mod_arr, config), [server]), **info)
+
+    def relink_keys():
+        for entry in os.scandir(key_path):
+            os.unlink(entry.path)
+        stats = reconcile.new_stats()
+        reconcile.reconcile_keys(reconcile.plan(mod_arr, config)['keys'], key_path, stats)
+    timed(results, 'key_links', relink_keys, **info)
+
+    # .zsync handling after every mod was renamed
+    a3sync = dict(arma3sync.link_target(config), stage=None)
+    reconcile.apply(reconcile.plan(mod_arr, config), [a3sync])
+    for folder_name, input_path in reconcile.plan(mod_arr, config)['mods'].items():
+        for entry in manifest.get_manifest(input_path):
+            if not entry.is_dir:
+                open(os.path.join(a3sync['path'], folder_name, entry.link_path) + '.zsync', 'w').close()
+    renamed = [dict(mod, folder_name=mod['folder_name'] + '_renamed') for mod in mod_arr]
+    timed(results, 'a3sync_zsync_relocation', lambda: reconcile.apply(reconcile.plan(renamed, config), [a3sync]),
+          **info)
+
+    timed(results, 'html_preset', lambda: html_preset.generate(mod_arr, config), **info)
+
+    # Full runs of the cli against a fake SteamCMD and a local Web API stand-in
+    web_api_server = serve_web_api(FakeWebAPI(COLLECTION_ID, published_files, 'Benchmark'))
+    config['steam_api'] = {'base_url': 'http://127.0.0.1:{}'.format(web_api_server.server_address[1]),
+                           'chunk_size': 100, 'concurrency': 8}
+    config_path = os.path.join(root, 'a3update.yaml')
+    with open(config_path, 'w') as f:
+        f.write(yaml.safe_dump(config))
+    steam_cmd = FakeSteamCMD(config['steamcmd_dir'], published_files)
+    pysteamcmdwrapper.SteamCMD = lambda path: steam_cmd
+    download.run_steamcmd = lambda s, command: s.run(command)
+
+    def cli_run(*args):
+        result = CliRunner().invoke(a3update.cli, ['-c', config_path, '-u', 'anonymous', '-p', ''] + list(args))
+        if result.exit_code:
+            raise RuntimeError(result.output) from result.exception
+    timed(results, 'cli_first_run', cli_run, **info)
+    timed(results, 'cli_noop_run', cli_run, **info)
+    timed(results, 'cli_plan_run', lambda: cli_run('--plan'), **info)
+    web_api_server.shutdown()
+    return results
+
+
+@click.command()
+@click.option('--scale', type=click.Choice(sorted(SCALES)), default='small', show_default=True)
+@click.option('--mods', type=int, help='Number of mods, overrides --scale')
+@click.option('--files', type=int, help='Files per mod, overrides --scale')
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Write JSON results to this file')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), help='Previous JSON results to compare to')
+def main(scale, mods, files, output, compare):
+    default_mods, default_files = SCALES[scale]
+    mods = mods or default_mods
+    files = files or default_files
+
+    root = tempfile.mkdtemp(prefix='a3update-bench-')
+    try:
+        results = run_benchmarks(root, mods, files)
+    finally:
+        shutil.rmtree(root)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': int(time.time()),
+        'results': results,
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        click.echo(json.dumps(report, indent=2))
+
+    if compare:
+        with open(compare, 'r') as f:
+            previous = {r['benchmark']: r for r in json.load(f)['results']}
+        for r in results:
+            if r['benchmark'] in previous and previous[r['benchmark']]['seconds']:
+                click.echo('{:<24} {:>7.2f}x'.format(r['benchmark'],
+                                                    r['seconds'] / previous[r['benchmark']]['seconds']), err=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,9 +8,10 @@ setup(name='a3update.py',
           'Click',
           'PyYAML',
           'Py-SteamCMD-Wrapper>=1.1.0',
-          'steam',
+          'requests',
           'pycryptodomex',
           'pathvalidate',
+          'vdf',
       ],
       entry_points='''
         [console_scripts]
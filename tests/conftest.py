@@ -0,0 +1,28 @@
+import importlib
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from a3update import manifest  # noqa: E402
+from benchmarks.run import generate_workshop, make_config, mod_array  # noqa: E402
+
+a3update = importlib.import_module('a3update.a3update')
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    # The benchmark config, installed as the global config the modules read
+    config = make_config(str(tmp_path))
+    monkeypatch.setattr(a3update, 'CONFIG_YAML', config, raising=False)
+    monkeypatch.setattr(a3update, 'WORKSHOP_DIR', config['mod_dir_full'], raising=False)
+    manifest.clear()
+    yield config
+    manifest.clear()
+
+
+@pytest.fixture
+def mods(config):
+    # Three installed workshop items with a few files each
+    return mod_array(generate_workshop(config['mod_dir_full'], 3, 4))
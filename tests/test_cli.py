@@ -0,0 +1,63 @@
+import importlib
+import os
+import pysteamcmdwrapper
+import pytest
+import yaml
+from click.testing import CliRunner
+from a3update import download
+from benchmarks.fakes import FakeSteamCMD, FakeWebAPI, serve_web_api
+from benchmarks.run import generate_workshop
+
+a3update = importlib.import_module('a3update.a3update')
+
+
+@pytest.fixture
+def config_path(config):
+    published_files = generate_workshop(config['mod_dir_full'], 3, 4)
+    server = serve_web_api(FakeWebAPI(1, published_files))
+    config['steam_api'] = {'base_url': 'http://127.0.0.1:{}'.format(server.server_address[1])}
+    path = os.path.join(config['mod_dir'], 'a3update.yaml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    yield path, published_files
+    server.shutdown()
+
+
+@pytest.mark.parametrize('args', [['--plan'], ['rollback'], ['export-delta', 'bundle.tar']])
+def test_runs_without_login_do_not_ask_for_credentials(config_path, args, monkeypatch):
+    path, _ = config_path
+    monkeypatch.chdir(os.path.dirname(path))
+    result = CliRunner().invoke(a3update.cli, ['-c', path] + args, input='')
+    assert result.exit_code == 0, result.output
+    assert 'Steam username' not in result.output
+
+
+def test_runs_that_log_in_ask_for_credentials(config_path, monkeypatch):
+    path, published_files = config_path
+    steam_cmd = FakeSteamCMD(os.path.dirname(path), published_files)
+    logins = []
+    monkeypatch.setattr(steam_cmd, 'login', lambda uname=None, passw=None: logins.append((uname, passw)))
+    monkeypatch.setattr(pysteamcmdwrapper, 'SteamCMD', lambda path: steam_cmd)
+    monkeypatch.setattr(download, 'run_steamcmd', lambda s, command: s.run(command))
+    result = CliRunner().invoke(a3update.cli, ['-c', path], input='user\nsecret\n')
+    assert result.exit_code == 0, result.output
+    assert 'Steam username' in result.output
+    assert logins == [('user', 'secret')]
+
+
+def test_rollback_clears_publisher_state(config, config_path):
+    path, _ = config_path
+    with open(path) as f:
+        written = yaml.safe_load(f)
+    written['swifty'] = dict(written['swifty'], active=True, native=True,
+                             output_path=os.path.join(config['mod_dir'], 'swifty'))
+    with open(path, 'w') as f:
+        yaml.safe_dump(written, f)
+    state_paths = [os.path.join(config['mod_dir'], name) for name in ('publish-state.json', 'swifty-state.json')]
+    for state_path in state_paths:
+        with open(state_path, 'w') as f:
+            f.write('{}')
+
+    result = CliRunner().invoke(a3update.cli, ['-c', path, 'rollback'])
+    assert result.exit_code == 0, result.output
+    assert not any(os.path.exists(state_path) for state_path in state_paths)
@@ -0,0 +1,109 @@
+import io
+import json
+import os
+import tarfile
+import click
+import pytest
+from a3update import delta, manifest, workshop
+from a3update.file_index import FileIndex
+from benchmarks.run import make_config
+
+
+@pytest.fixture
+def replica(tmp_path):
+    config = make_config(str(tmp_path / 'replica'))
+    file_index = FileIndex(os.path.join(config['mod_dir'], 'file-index.sqlite3'), config['mod_dir_full'])
+    yield config, file_index
+    file_index.close()
+
+
+@pytest.fixture
+def file_index(config):
+    file_index = FileIndex(os.path.join(config['mod_dir'], 'file-index.sqlite3'), config['mod_dir_full'])
+    yield file_index
+    file_index.close()
+
+
+def _export(config, mods, file_index, name, previous=None):
+    manifest.clear()
+    file_index.update([mod['published_file_id'] for mod in mods],
+                      folder_names={mod['published_file_id']: mod['folder_name'] for mod in mods})
+    bundle = os.path.join(config['mod_dir'], name)
+    return bundle, delta.export(mods, file_index, bundle, previous)
+
+
+def _tree(mod_dir_full):
+    tree = {}
+    for root, dirs, files in os.walk(mod_dir_full):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                tree[os.path.relpath(path, mod_dir_full)] = f.read()
+    return tree
+
+
+def _bundle(path, current):
+    data = json.dumps(current).encode()
+    with tarfile.open(path, 'w') as tar:
+        info = tarfile.TarInfo(delta.MANIFEST_NAME)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+
+def test_round_trip(config, mods, file_index, replica):
+    replica_config, replica_index = replica
+    bundle, (current, objects, _) = _export(config, mods, file_index, 'full.tar')
+    assert objects == len(current['files'])
+
+    manifest.clear()
+    delta.apply(bundle, replica_index, replica_config['mod_dir'])
+    assert _tree(replica_config['mod_dir_full']) == _tree(config['mod_dir_full'])
+    assert sorted(workshop.installed_ids(replica_config['mod_dir'])) == [mod['published_file_id'] for mod in mods]
+
+    # Only changed content is bundled since the previous manifest, moved files are copied on the replica
+    mod_path = os.path.join(config['mod_dir_full'], mods[0]['published_file_id'])
+    with open(os.path.join(mod_path, 'mod.cpp'), 'a') as f:
+        f.write('// changed\n')
+    os.rename(os.path.join(mod_path, 'Addons'), os.path.join(mod_path, 'Moved'))
+    bundle, (_, objects, _) = _export(config, mods, file_index, 'delta.tar', current)
+    assert objects == 1
+
+    manifest.clear()
+    assert delta.apply(bundle, replica_index, replica_config['mod_dir'])[:2] == (1, 3)
+    assert _tree(replica_config['mod_dir_full']) == _tree(config['mod_dir_full'])
+
+
+def test_path_ignored_files_are_not_bundled(config, mods, file_index):
+    config['files_folders_to_ignore'] = ['{}/Addons/**'.format(mods[0]['folder_name'])]
+    _, (current, _, _) = _export(config, mods, file_index, 'full.tar')
+    assert not any(path.startswith('{}/Addons/'.format(mods[0]['published_file_id'])) for path in current['files'])
+    assert any(path.startswith('{}/Addons/'.format(mods[1]['published_file_id'])) for path in current['files'])
+
+
+def test_bundle_since_another_manifest_is_refused(config, mods, file_index, replica):
+    replica_config, replica_index = replica
+    _, (current, _, _) = _export(config, mods, file_index, 'full.tar')
+    bundle, _ = _export(config, mods, file_index, 'delta.tar', current)
+    with pytest.raises(click.ClickException, match='neither in the bundle nor on this node'):
+        delta.apply(bundle, replica_index, replica_config['mod_dir'])
+
+
+@pytest.mark.parametrize('published_file_id, path', [
+    ('../450000000', '../450000000/mod.cpp'),
+    ('450000000', '450000000/../../escape'),
+    ('450000000', '/tmp/escape'),
+    ('450000000', '450000001/mod.cpp'),
+    ('450000000', '450000000//mod.cpp'),
+    ('450000000', '450000000'),
+])
+def test_unsafe_bundles_are_refused(replica, published_file_id, path):
+    replica_config, replica_index = replica
+    bundle = os.path.join(replica_config['mod_dir'], 'unsafe.tar')
+    _bundle(bundle, {'version': delta.VERSION, 'mods': [{
+        'published_file_id': published_file_id, 'name': 'Mod', 'time_updated': 0, 'file_size': 0,
+    }], 'files': {path: {'size': 0, 'mtime': 0, 'sha1': 'da39a3ee5e6b4b0d3255bfef95601890afd80709'}}})
+
+    with pytest.raises(click.ClickException, match='Invalid'):
+        delta.apply(bundle, replica_index, replica_config['mod_dir'])
+    assert os.listdir(replica_config['mod_dir_full']) == []
+    assert not os.path.exists(workshop.acf_path(replica_config['mod_dir']))
@@ -0,0 +1,138 @@
+import os
+import re
+from a3update import download, workshop
+from benchmarks.fakes import FakeSteamCMD
+
+
+def _mods(*sizes):
+    return [{'name': 'Mod {}'.format(i), 'published_file_id': str(450000000 + i), 'file_size': size,
+             'time_updated': 1600000000} for i, size in enumerate(sizes)]
+
+
+def _ids(command):
+    return re.findall(r'\+workshop_download_item \d+ (\d+)', command.get_cmd())
+
+
+def test_schedule_spreads_the_largest_mods():
+    buckets = download.schedule(_mods(100, 90, 10, 10, 5), 2)
+    assert sorted(sum(mod['file_size'] for mod in bucket) for bucket in buckets) == [105, 110]
+    assert download.schedule(_mods(1), 4) == [_mods(1)]
+
+
+def test_only_failed_items_are_retried(tmp_path):
+    mods = _mods(1, 1, 1)
+    attempts = []
+
+    def run(command):
+        ids = _ids(command)
+        attempts.append(ids)
+        # The second item fails twice before it succeeds
+        return '\n'.join('ERROR! Download item {} failed (Timeout)'.format(i)
+                         if i == mods[1]['published_file_id'] and len(attempts) < 3
+                         else 'Success. Downloaded item {} to "x" (0 bytes)'.format(i) for i in ids)
+
+    assert download.download(run, mods, str(tmp_path), backoff=0) == []
+    assert attempts == [[mod['published_file_id'] for mod in mods], [mods[1]['published_file_id']],
+                        [mods[1]['published_file_id']]]
+
+
+def test_items_fail_after_max_tries(tmp_path):
+    mods = _mods(1, 1)
+    calls = []
+
+    def run(command):
+        calls.append(_ids(command))
+        # No result for the first item, an error for the second
+        return 'ERROR! Download item {} failed (No subscription)'.format(mods[1]['published_file_id'])
+
+    failed = download.download(run, mods, str(tmp_path), max_tries=3, backoff=0)
+    assert [(mod['published_file_id'], mod['error']) for mod in failed] == [
+        (mods[0]['published_file_id'], 'No result reported by SteamCMD'),
+        (mods[1]['published_file_id'], 'No subscription')]
+    assert len(calls) == 3
+
+
+def test_batches_respect_the_command_length(tmp_path):
+    mods = _mods(*[1] * 10)
+    steam_cmd = FakeSteamCMD(str(tmp_path))
+    assert download.download(steam_cmd.run, mods, str(tmp_path), max_command_length=150) == []
+    assert len(steam_cmd.commands) > 1
+    assert all(len(command) <= 150 for command in steam_cmd.commands)
+    assert sorted(workshop.installed_ids(str(tmp_path))) == [mod['published_file_id'] for mod in mods]
+
+
+def test_workers_leave_installed_items_in_place(tmp_path):
+    mod_dir = str(tmp_path)
+    mods = _mods(3, 2, 1)
+    installed = os.path.join(workshop.content_dir(mod_dir), mods[0]['published_file_id'])
+    os.makedirs(installed)
+    with open(os.path.join(installed, 'mod.cpp'), 'w') as f:
+        f.write('old')
+    steam_cmd = FakeSteamCMD(mod_dir, {mod['published_file_id']: mod for mod in mods})
+
+    def run(command):
+        # The installed item is untouched while its copy is repaired in place
+        if mods[0]['published_file_id'] in _ids(command):
+            with open(os.path.join(installed, 'mod.cpp')) as f:
+                assert f.read() == 'old'
+        for published_file_id in _ids(command):
+            path = os.path.join(workshop.content_dir(re.search(r'"([^"]*)"', command.get_cmd()).group(1)),
+                                published_file_id, 'mod.cpp')
+            if os.path.exists(path):
+                with open(path, 'r+') as f:
+                    f.write('new')
+        output = steam_cmd.run(command)
+        if mods[0]['published_file_id'] in _ids(command):
+            with open(os.path.join(installed, 'mod.cpp')) as f:
+                assert f.read() == 'old'
+        return output
+
+    assert download.download(run, mods, mod_dir, workers=3) == []
+    with open(os.path.join(installed, 'mod.cpp')) as f:
+        assert f.read() == 'new'
+    # The worker manifests are merged, so the next run finds nothing to update
+    installed_items = workshop.installed_items(mod_dir, workshop.content_dir(mod_dir))
+    assert {i: item['time_updated'] for i, item in installed_items.items()} == \
+        {mod['published_file_id']: mod['time_updated'] for mod in mods}
+    assert workshop.outdated_mods(mods, installed_items) == []
+    assert os.listdir(os.path.join(mod_dir, 'workers')) == []
+
+
+def test_workers_on_first_install(tmp_path):
+    mod_dir = str(tmp_path)
+    mods = _mods(2, 1)
+    steam_cmd = FakeSteamCMD(mod_dir, {mod['published_file_id']: mod for mod in mods})
+    assert download.download(steam_cmd.run, mods, mod_dir, workers=2) == []
+    assert sorted(workshop.installed_items(mod_dir, workshop.content_dir(mod_dir))) == \
+        [mod['published_file_id'] for mod in mods]
+
+
+def test_failed_items_keep_their_installed_copy(tmp_path):
+    mod_dir = str(tmp_path)
+    mods = _mods(2, 1)
+    installed = os.path.join(workshop.content_dir(mod_dir), mods[0]['published_file_id'])
+    os.makedirs(installed)
+
+    def run(command):
+        return '\n'.join('ERROR! Download item {} failed (Timeout)'.format(i) for i in _ids(command))
+
+    assert len(download.download(run, mods, mod_dir, workers=2, max_tries=1)) == 2
+    assert os.path.isdir(installed)
+    assert os.listdir(os.path.join(mod_dir, 'workers')) == []
+
+
+def test_stranded_items_are_recovered(tmp_path):
+    mod_dir = str(tmp_path)
+    mod_dir_full = workshop.content_dir(mod_dir)
+    worker_dir_full = workshop.content_dir(os.path.join(mod_dir, 'workers', '0'))
+    # One item was moved out of mod_dir_full, the other one is only a copy
+    os.makedirs(os.path.join(worker_dir_full, '1'))
+    os.makedirs(os.path.join(worker_dir_full, '2'))
+    os.makedirs(os.path.join(mod_dir_full, '2'))
+    with open(os.path.join(mod_dir_full, '2', 'mod.cpp'), 'w') as f:
+        f.write('installed')
+
+    assert download.download(lambda command: '', [], mod_dir) == []
+    assert sorted(os.listdir(mod_dir_full)) == ['1', '2']
+    assert os.path.isfile(os.path.join(mod_dir_full, '2', 'mod.cpp'))
+    assert os.listdir(os.path.join(mod_dir, 'workers')) == []
@@ -0,0 +1,30 @@
+import os
+from a3update import files
+
+
+def test_save_and_load_json(tmp_path):
+    path = os.path.join(str(tmp_path), 'state.json')
+    assert files.load_json(path) is None
+    assert files.load_json(path, {}) == {}
+    files.save_json(path, {'a': 1})
+    assert files.load_json(path) == {'a': 1}
+    assert os.listdir(str(tmp_path)) == ['state.json']
+
+
+def test_corrupt_json_counts_as_missing(tmp_path):
+    path = os.path.join(str(tmp_path), 'state.json')
+    with open(path, 'w') as f:
+        f.write('{"a": ')
+    assert files.load_json(path, {}) == {}
+
+
+def test_failed_write_keeps_the_old_file(tmp_path):
+    path = os.path.join(str(tmp_path), 'state.json')
+    files.save_json(path, {'a': 1})
+    try:
+        with files.atomic_write(path) as f:
+            f.write('{"a": ')
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert files.load_json(path) == {'a': 1}
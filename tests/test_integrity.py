@@ -0,0 +1,51 @@
+import os
+from a3update import integrity, manifest, reconcile
+from a3update.file_index import FileIndex
+
+
+def _index(config, mods):
+    file_index = FileIndex(os.path.join(config['mod_dir'], 'file-index.sqlite3'), config['mod_dir_full'])
+    # Indexed after planning, the way a run does
+    reconcile.plan(mods, config, file_index)
+    file_index.update([mod['published_file_id'] for mod in mods])
+    manifest.clear()
+    return file_index
+
+
+def test_path_scoped_ignore_rules_do_not_drift(config, mods):
+    config['files_folders_to_ignore'] = ['{}/Addons/**'.format(mods[0]['folder_name'])]
+    file_index = _index(config, mods)
+    assert integrity.drifted(mods, file_index) == []
+    file_index.close()
+
+
+def test_changed_file_drifts(config, mods):
+    file_index = _index(config, mods)
+    with open(os.path.join(config['mod_dir_full'], mods[1]['published_file_id'], 'mod.cpp'), 'a') as f:
+        f.write('// changed\n')
+    assert [mod['published_file_id'] for mod in integrity.drifted(mods, file_index)] == \
+        [mods[1]['published_file_id']]
+    file_index.close()
+
+
+def test_sampled_content_drifts(config, mods):
+    file_index = _index(config, mods)
+    path = os.path.join(config['mod_dir_full'], mods[2]['published_file_id'], 'mod.cpp')
+    stat = os.stat(path)
+    with open(path, 'r+') as f:
+        f.write('X')
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert integrity.drifted(mods[2:], file_index) == []
+    assert integrity.drifted(mods[2:], file_index, sample_files=100) == mods[2:]
+    file_index.close()
+
+
+def test_kept_mods_stay_drifted(config, mods):
+    file_index = _index(config, mods)
+    with open(os.path.join(config['mod_dir_full'], mods[1]['published_file_id'], 'mod.cpp'), 'a') as f:
+        f.write('// corrupt\n')
+    # A failed repair keeps the old rows, so the item still fails the next check
+    file_index.update([mod['published_file_id'] for mod in mods], keep={mods[1]['published_file_id']})
+    manifest.clear()
+    assert integrity.drifted(mods, file_index) == [mods[1]]
+    file_index.close()
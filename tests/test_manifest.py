@@ -0,0 +1,25 @@
+import os
+from a3update import manifest
+
+
+def test_path_scoped_rules_apply_on_cache_hit(config, mods):
+    config['files_folders_to_ignore'] = ['{}/Addons/**'.format(mods[0]['folder_name'])]
+    input_path = os.path.join(config['mod_dir_full'], mods[0]['published_file_id'])
+
+    # A scan without a folder name cannot match path scoped rules
+    assert any(entry.path.startswith('Addons') for entry in manifest.get_manifest(input_path))
+
+    scoped = manifest.get_manifest(input_path, mods[0]['folder_name'])
+    assert not any(entry.path.startswith('Addons') for entry in scoped)
+    assert manifest.ignored_count() == 1
+    # Callers that do not know the folder name get the scoped scan
+    assert manifest.get_manifest(input_path) is scoped
+
+
+def test_clear_keeps_current_manifests(config, mods):
+    paths = [os.path.join(config['mod_dir_full'], mod['published_file_id']) for mod in mods]
+    kept = manifest.get_manifest(paths[0])
+    dropped = manifest.get_manifest(paths[1])
+    manifest.clear(keep={paths[0]})
+    assert manifest.get_manifest(paths[0]) is kept
+    assert manifest.get_manifest(paths[1]) is not dropped
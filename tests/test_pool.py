@@ -0,0 +1,22 @@
+import hashlib
+import threading
+from a3update.file_index import _sha1
+from a3update.pool import process_pool
+
+
+def test_workers_are_not_forked(tmp_path):
+    path = str(tmp_path / 'file')
+    with open(path, 'wb') as f:
+        f.write(b'a3update')
+    results = []
+
+    # Pools are created from the threads that link the profiles
+    def hash_file():
+        with process_pool(2) as executor:
+            assert executor._mp_context.get_start_method() != 'fork'
+            results.extend(executor.map(_sha1, [path]))
+
+    thread = threading.Thread(target=hash_file)
+    thread.start()
+    thread.join()
+    assert results == [hashlib.sha1(b'a3update').hexdigest()]
@@ -0,0 +1,46 @@
+import importlib
+import os
+import click
+import pytest
+
+a3update = importlib.import_module('a3update.a3update')
+
+
+def _profiles(config, **overrides):
+    config['profiles'] = {
+        'main': {'install_dir': os.path.join(config['mod_dir'], 'main')},
+        'event': dict({'install_dir': os.path.join(config['mod_dir'], 'event')}, **overrides),
+    }
+    return a3update._profiles()
+
+
+def test_profiles_keep_state_apart(config):
+    config['html_preset']['active'] = False
+    main, event = _profiles(config)
+    assert (main['name'], event['name']) == ('main', 'event')
+    assert main['staging']['directory'] != event['staging']['directory']
+    assert main['publish_state'] != event['publish_state']
+    assert main['swifty']['state_path'] != event['swifty']['state_path']
+
+
+def test_profiles_cannot_override_shared_keys(config):
+    config['html_preset']['active'] = False
+    _, event = _profiles(config, mod_dir='/elsewhere')
+    assert event['mod_dir'] == config['mod_dir']
+
+
+def test_shared_install_dir_is_rejected(config):
+    config['html_preset']['active'] = False
+    with pytest.raises(click.ClickException, match='install_dir'):
+        _profiles(config, install_dir=os.path.join(config['mod_dir'], 'main'))
+
+
+def test_inherited_publisher_outputs_are_rejected(config):
+    with pytest.raises(click.ClickException, match='html_preset.path_to_html'):
+        _profiles(config)
+
+    config['html_preset']['active'] = False
+    config['a3sync']['active'] = True
+    with pytest.raises(click.ClickException, match='a3sync.directory'):
+        _profiles(config)
+    _profiles(config, a3sync=dict(config['a3sync'], directory=os.path.join(config['mod_dir'], 'a3sync-event')))
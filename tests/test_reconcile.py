@@ -0,0 +1,78 @@
+import os
+from a3update import reconcile, staging
+
+
+def _target(config):
+    return {'path': config['install_dir'], 'key_path': os.path.join(config['install_dir'], 'keys'),
+            'stage': staging.stage_dir(config, 'server')}
+
+
+def _linked(path):
+    return sorted(name for name in os.listdir(path) if name.startswith('@') and os.path.isdir(os.path.join(path, name)))
+
+
+def test_link_and_prune(config, mods):
+    config['staging'] = {'active': False}
+    target = _target(config)
+    [stats] = reconcile.apply(reconcile.plan(mods, config), [target])
+    assert _linked(config['install_dir']) == sorted(mod['folder_name'] for mod in mods)
+    assert stats['created'] > 0
+    assert len(os.listdir(target['key_path'])) == 2
+
+    # A second run changes nothing, a removed mod is pruned
+    [stats] = reconcile.apply(reconcile.plan(mods, config), [target])
+    assert stats == reconcile.new_stats()
+    [stats] = reconcile.apply(reconcile.plan(mods[1:], config), [target])
+    assert _linked(config['install_dir']) == sorted(mod['folder_name'] for mod in mods[1:])
+    assert stats['removed'] == 1
+
+
+def test_dry_run_changes_nothing(config, mods):
+    target = _target(config)
+    [stats] = reconcile.apply(reconcile.plan(mods, config), [target], dry_run=True)
+    assert stats['created'] > 0
+    assert _linked(config['install_dir']) == []
+    assert staging.current_path(target['stage']) is None
+
+
+def test_staged_publish_and_rollback(config, mods):
+    target = _target(config)
+    reconcile.apply(reconcile.plan(mods[:2], config), [target])
+    # Nothing is public before the generation is published
+    assert _linked(config['install_dir']) == []
+    reconcile.publish([target])
+    assert _linked(config['install_dir']) == sorted(mod['folder_name'] for mod in mods[:2])
+
+    reconcile.apply(reconcile.plan(mods, config), [target])
+    reconcile.publish([target])
+    assert _linked(config['install_dir']) == sorted(mod['folder_name'] for mod in mods)
+
+    assert staging.rollback(target['stage'])
+    stats = reconcile.new_stats()
+    staging.publish_links(target['stage'], config['install_dir'], stats)
+    assert _linked(config['install_dir']) == sorted(mod['folder_name'] for mod in mods[:2])
+
+
+def test_staged_delta_run_keeps_unchanged_mods(config, mods):
+    target = _target(config)
+    reconcile.apply(reconcile.plan(mods, config), [target])
+    reconcile.publish([target])
+
+    # Two delta runs, so one builds into a fresh generation and one into the generation before the live one
+    for mod in mods[:2]:
+        with open(os.path.join(config['mod_dir_full'], mod['published_file_id'], 'mod.cpp'), 'a') as f:
+            f.write('// changed\n')
+        reconcile.apply(reconcile.plan(mods, config), [target], only={mod['folder_name']})
+        [stats] = reconcile.publish([target])
+        assert stats['removed'] == 0
+        assert _linked(config['install_dir']) == sorted(mod['folder_name'] for mod in mods)
+        assert os.path.isfile(os.path.join(config['install_dir'], mods[2]['folder_name'], 'mod.cpp'))
+
+
+def test_missing_mods_are_left_out(config, mods):
+    config['staging'] = {'active': False}
+    missing = dict(mods[0], published_file_id='450000099', folder_name='@missing')
+    link_plan = reconcile.plan(mods + [missing], config)
+    assert '@missing' not in link_plan['mods']
+    reconcile.apply(link_plan, [_target(config)])
+    assert _linked(config['install_dir']) == sorted(mod['folder_name'] for mod in mods)
@@ -0,0 +1,45 @@
+import pytest
+from a3update.steam_api import SteamWebAPI
+from benchmarks.fakes import FakeWebAPI, serve_web_api
+
+
+@pytest.fixture
+def web_api():
+    web_api = FakeWebAPI(1, {str(450000000 + i): {'title': 'Mod {}'.format(i)} for i in range(250)})
+    server = serve_web_api(web_api)
+    yield web_api, 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+
+
+def test_long_id_lists_are_chunked_and_merged(web_api):
+    web_api, base_url = web_api
+    api = SteamWebAPI(base_url=base_url, chunk_size=100, concurrency=2)
+    ids = list(web_api.published_files)
+    response = api.call('ISteamRemoteStorage.GetPublishedFileDetails', itemcount=len(ids), publishedfileids=ids)
+    api.close()
+
+    assert web_api.calls == 3
+    assert response['response']['resultcount'] == 250
+    # Chunks are merged in the order of the ids
+    assert [d['publishedfileid'] for d in response['response']['publishedfiledetails']] == ids
+    assert response['response']['publishedfiledetails'][249]['title'] == 'Mod 249'
+
+
+def test_collection_details(web_api):
+    web_api, base_url = web_api
+    api = SteamWebAPI(base_url=base_url)
+    response = api.call('ISteamRemoteStorage.GetCollectionDetails', collectioncount=1, publishedfileids=[1])
+    api.close()
+
+    [collection] = response['response']['collectiondetails']
+    assert collection['publishedfileid'] == '1'
+    assert len(collection['children']) == 250
+
+
+def test_empty_id_list_is_one_request(web_api):
+    web_api, base_url = web_api
+    api = SteamWebAPI(base_url=base_url)
+    response = api.call('ISteamRemoteStorage.GetPublishedFileDetails', itemcount=0, publishedfileids=[])
+    api.close()
+    assert web_api.calls == 1
+    assert response['response']['resultcount'] == 0
@@ -0,0 +1,74 @@
+import pytest
+from a3update import watch
+from a3update.steam_api import RateLimitError
+
+
+class Stop(BaseException):
+    pass
+
+
+def _mods(**time_updated):
+    return [{'published_file_id': i, 'time_updated': t} for i, t in time_updated.items()]
+
+
+def _run(polls, apply, **options):
+    # Runs the loop until polls is exhausted, returns the seconds slept
+    now = [0]
+    sleeps = []
+    polls = iter(polls)
+
+    def poll():
+        result = next(polls, Stop())
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    with pytest.raises(Stop):
+        watch.run(poll, apply, sleep=sleep, clock=lambda: now[0], **options)
+    return sleeps
+
+
+def test_diff():
+    assert watch.diff({'a': 1, 'b': 1, 'c': 1}, {'b': 2, 'c': 1, 'd': 1}) == ({'d'}, {'a'}, {'b'})
+
+
+def test_burst_is_applied_once():
+    applied = []
+    sleeps = _run([_mods(a=1, b=1, c=1), _mods(a=1, b=2, c=1), _mods(a=1, b=2, c=2), _mods(a=1, b=2, c=2),
+                   _mods(a=1, b=2, c=2)], lambda mods, changed: applied.append(changed), interval=300, settle=60)
+    assert applied == [None, {'b', 'c'}]
+    assert sleeps == [300, 60, 60, 300, 300]
+
+
+def test_long_burst_is_applied_after_interval():
+    applied = []
+    _run([_mods(a=n) for n in range(8)], lambda mods, changed: applied.append(changed), interval=120, settle=60)
+    # Changes keep coming, so they are applied once they have been pending for the interval
+    assert applied == [None, {'a'}, {'a'}]
+
+
+def test_rate_limit_backs_off():
+    applied = []
+    sleeps = _run([RateLimitError(900), _mods(a=1), ValueError('boom'), RateLimitError(), ValueError('boom'),
+                   _mods(a=1)], lambda mods, changed: applied.append(changed), interval=300, max_backoff=1000)
+    # retry_after is honoured, other failures back off exponentially up to max_backoff,
+    # a successful poll resets the backoff
+    assert sleeps == [900, 300, 300, 600, 1000, 300]
+    assert applied == [None]
+
+
+def test_failed_apply_is_retried():
+    calls = []
+
+    def apply(mods, changed):
+        calls.append(changed)
+        if len(calls) in (1, 3):
+            raise RuntimeError('SteamCMD failed')
+
+    _run([_mods(a=1), _mods(a=1), _mods(a=2), _mods(a=2), _mods(a=2)], apply, interval=300, settle=60)
+    # The full run and the delta run are both retried after the next poll, nothing is lost
+    assert calls == [None, None, {'a'}, {'a'}]
@@ -0,0 +1,88 @@
+import importlib
+import click
+import pytest
+from a3update.webapi_cache import WebAPICache
+from benchmarks.fakes import FakeWebAPI
+
+a3update = importlib.import_module('a3update.a3update')
+
+PUBLISHED_FILES = {'450000000': {'title': 'Mod 0', 'time_updated': 1600000000, 'file_size': 2048},
+                   '450000001': {'title': 'Mod 1', 'time_updated': 1600000001, 'file_size': 4096}}
+
+
+def _cache(monkeypatch, tmp_path, api, offline=False):
+    cache = WebAPICache(api, str(tmp_path), offline=offline)
+    monkeypatch.setattr(a3update, 'STEAM_WEBAPI', cache, raising=False)
+    return cache
+
+
+def test_resolve_collection(monkeypatch, tmp_path):
+    _cache(monkeypatch, tmp_path, FakeWebAPI(1, PUBLISHED_FILES))
+    mods = a3update._workshop_ids_to_mod_array(a3update._get_collection_workshop_ids([1]))
+    assert [(mod['folder_name'], mod['published_file_id'], mod['file_size']) for mod in mods] == [
+        ('@mod_0', '450000000', 2048), ('@mod_1', '450000001', 4096)]
+
+
+def test_offline_uses_cached_responses(monkeypatch, tmp_path):
+    api = FakeWebAPI(1, PUBLISHED_FILES)
+    _cache(monkeypatch, tmp_path, api)
+    online = a3update._workshop_ids_to_mod_array(a3update._get_collection_workshop_ids([1]))
+    calls = api.calls
+
+    _cache(monkeypatch, tmp_path, None, offline=True)
+    assert a3update._workshop_ids_to_mod_array(a3update._get_collection_workshop_ids([1])) == online
+    assert api.calls == calls
+
+
+def test_offline_without_cached_response(monkeypatch, tmp_path):
+    _cache(monkeypatch, tmp_path, None, offline=True)
+    with pytest.raises(click.ClickException, match='--offline'):
+        a3update._get_collection_workshop_ids([1])
+    with pytest.raises(click.ClickException, match='workshop items'):
+        a3update._workshop_ids_to_mod_array(['450000000'])
+    assert a3update._workshop_ids_to_mod_array([]) == []
+
+
+# Collections 1 and 4 are roots, 1 and 2 contain each other, 2 and 3 as well
+GRAPH = {'1': [('10', 0), ('2', 2), ('11', 0)],
+         '2': [('12', 0), ('1', 2), ('10', 0), ('3', 2)],
+         '3': [('13', 0), ('2', 2)],
+         '4': [('3', 2), ('14', 0)]}
+
+
+class GraphWebAPI:
+    offline = False
+
+    def __init__(self):
+        self.levels = []
+
+    def call(self, method_path, **params):
+        ids = [str(i) for i in params['publishedfileids']]
+        if method_path == 'ISteamRemoteStorage.GetCollectionDetails':
+            self.levels.append(ids)
+            return {'response': {'resultcount': len(ids), 'collectiondetails': [{
+                'publishedfileid': i, 'result': 1,
+                'children': [{'publishedfileid': child, 'filetype': filetype} for child, filetype in GRAPH[i]],
+            } for i in ids]}}
+        return {'response': {'resultcount': len(ids), 'publishedfiledetails': [
+            {'publishedfileid': i, 'result': 1, 'title': 'Item {}'.format(i)} for i in ids]}}
+
+
+@pytest.mark.parametrize('roots, order, levels', [
+    ([1], ['10', '12', '13', '11'], [['1'], ['2'], ['3']]),
+    ([1, 4], ['10', '12', '13', '11', '14'], [['1', '4'], ['2', '3']]),
+    ([4, 1, 4], ['13', '12', '10', '11', '14'], [['4', '1'], ['3', '2']]),
+])
+def test_nested_collections(monkeypatch, roots, order, levels):
+    api = GraphWebAPI()
+    monkeypatch.setattr(a3update, 'STEAM_WEBAPI', api, raising=False)
+    # Depth first in collection order, every item once, one request per level of the graph
+    assert a3update._get_collection_workshop_ids(roots) == order
+    assert api.levels == levels
+
+
+def test_nested_collections_can_be_disabled(monkeypatch):
+    api = GraphWebAPI()
+    monkeypatch.setattr(a3update, 'STEAM_WEBAPI', api, raising=False)
+    assert a3update._get_collection_workshop_ids([1], nested_collections=False) == ['10', '11']
+    assert api.levels == [['1']]
@@ -0,0 +1,39 @@
+import os
+from a3update import workshop, workshop_gc
+from a3update.files import load_json
+
+
+def _install(config, mods):
+    acf = workshop.load_acf(config['mod_dir'])
+    installed = acf.setdefault('AppWorkshop', {}).setdefault('WorkshopItemsInstalled', {})
+    for mod in mods:
+        installed[mod['published_file_id']] = {'size': str(mod['file_size']), 'timeupdated': '0'}
+    workshop.save_acf(config['mod_dir'], acf)
+
+
+def test_orphans_are_kept_for_the_grace_period(config, mods):
+    _install(config, mods)
+    orphan = os.path.join(config['mod_dir_full'], mods[2]['published_file_id'])
+
+    used, orphaned, reclaimed = workshop_gc.collect(mods[:2], config)
+    assert used > 0 and orphaned > 0 and reclaimed == 0
+    assert os.path.isdir(orphan)
+
+    # Items back in a collection are no longer tracked
+    workshop_gc.collect(mods, config)
+    assert load_json(os.path.join(config['mod_dir'], 'gc-state.json')) == {}
+
+
+def test_expired_orphans_are_deleted(config, mods):
+    _install(config, mods)
+    config['gc'] = {'grace_period': 0}
+    orphan = os.path.join(config['mod_dir_full'], mods[2]['published_file_id'])
+
+    _, orphaned, reclaimed = workshop_gc.collect(mods[:2], config, dry_run=True)
+    assert orphaned == reclaimed > 0
+    assert os.path.isdir(orphan)
+
+    workshop_gc.collect(mods[:2], config)
+    assert not os.path.exists(orphan)
+    assert workshop.installed_ids(config['mod_dir']) == {mod['published_file_id'] for mod in mods[:2]}
+    assert all(os.path.isdir(os.path.join(config['mod_dir_full'], mod['published_file_id'])) for mod in mods[:2])
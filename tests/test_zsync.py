@@ -0,0 +1,76 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import pytest
+from Cryptodome.Hash import MD4
+from a3update import zsync
+
+MTIME = 1600000000
+
+
+def _write(tmp_path, length):
+    path = os.path.join(str(tmp_path), 'file_{}.pbo'.format(length))
+    with open(path, 'wb') as f:
+        f.write(bytes((i * 7 + i // 256) % 256 for i in range(length)))
+    os.utime(path, (MTIME, MTIME))
+    return path
+
+
+def _block_sums(data, blocksize, rsum_len, checksum_len):
+    # Written after rcksum_calc_rsum_block and write_block_sums of zsync 0.6.2's make.c:
+    # a and b are 16 bit sums stored big endian, the last rsum_len bytes of them are kept
+    sums = b''
+    for offset in range(0, len(data), blocksize):
+        block = data[offset:offset + blocksize].ljust(blocksize, b'\0')
+        a = b = 0
+        for i, c in enumerate(block):
+            a = (a + c) & 0xffff
+            b = (b + (blocksize - i) * c) & 0xffff
+        sums += bytes([a >> 8, a & 0xff, b >> 8, b & 0xff])[4 - rsum_len:]
+        sums += MD4.new(block).digest()[:checksum_len]
+    return sums
+
+
+# Hash lengths worked out from the formulas in zsyncmake's main()
+@pytest.mark.parametrize('length, hash_lengths', [(1000, (1, 2, 4)), (5000, (2, 2, 3)), (300000, (2, 2, 4))])
+def test_control_file(tmp_path, length, hash_lengths):
+    path = _write(tmp_path, length)
+    assert zsync.generate(path) == 1
+    with open(path, 'rb') as f:
+        data = f.read()
+    name = os.path.basename(path)
+    expected = (
+        'zsync: 0.6.2\n'
+        'Filename: {name}\n'
+        'MTime: Sun, 13 Sep 2020 12:26:40 +0000\n'
+        'Blocksize: 2048\n'
+        'Length: {length}\n'
+        'Hash-Lengths: {0},{1},{2}\n'
+        'URL: {name}\n'
+        'SHA-1: {sha1}\n'
+        '\n'
+    ).format(*hash_lengths, name=name, length=length, sha1=hashlib.sha1(data).hexdigest()).encode()
+    expected += _block_sums(data, 2048, hash_lengths[1], hash_lengths[2])
+    with open(path + '.zsync', 'rb') as f:
+        assert f.read() == expected
+
+
+def test_needs_update(tmp_path):
+    path = _write(tmp_path, 1000)
+    assert zsync.needs_update(path)
+    zsync.generate(path)
+    assert not zsync.needs_update(path)
+    os.utime(path + '.zsync', (MTIME - 1, MTIME - 1))
+    assert zsync.needs_update(path)
+
+
+@pytest.mark.skipif(shutil.which('zsyncmake') is None, reason='zsyncmake is not installed')
+@pytest.mark.parametrize('length', [1000, 5000, 300000])
+def test_same_output_as_zsyncmake(tmp_path, length):
+    path = _write(tmp_path, length)
+    zsync.generate(path)
+    reference = path + '.reference'
+    subprocess.check_call(['zsyncmake', '-u', os.path.basename(path), '-o', reference, path])
+    with open(path + '.zsync', 'rb') as f, open(reference, 'rb') as r:
+        assert f.read() == r.read()